@@ -8,6 +8,7 @@
 
 from ansible.module_utils.basic import *
 import requests
+import time
 try:
     import HTMLParser
 except ImportError:
@@ -17,6 +18,9 @@ ANSIBLE_METADATA = {'metadata_version': '1.1',
                     'status': ['preview'],
                     'supported_by': 'community'}
 
+WAIT_MAX_INTERVAL = 15
+DRAIN_RATE_WINDOW = 5
+
 DOCUMENTATION = u'''
 ---
 module: aem_agent
@@ -30,12 +34,18 @@ options:
     state:
         description:
             - State of agent
+            - drained waits until the replication queue of the agent, or of
+              every enabled agent in folder when name is not given, is
+              empty. Returns queues with the last size per agent,
+              drained_items, drain_rate (items/sec over the last polls),
+              eta_secs, drain_secs and polls. Fails as soon as a blocked queue did not shrink
+              between two polls, or at wait_timeout.
         required: true
-        choices: [present, absent, enabled, disabled, password]
+        choices: [present, absent, enabled, disabled, password, drained]
     name:
         description:
-            - agent name
-        required: true
+            - agent name, required except with state drained
+        required: false
         folder:
         description:
             - Folder containing agents. Usually 'agents.author' or 'agents.publish'.
@@ -139,6 +149,18 @@ options:
             - batch max size
         required: false
         default: null
+    wait_timeout:
+        description:
+            - Seconds to wait with state drained before failing
+        required: false
+        default: 600
+    wait_interval:
+        description:
+            - Seconds between the first polls with state drained. Doubled
+              while the queues do not shrink, otherwise adapted to the
+              estimated time to empty, up to 15 seconds.
+        required: false
+        default: 1
     admin_user:
         description:
             - AEM admin user account name
@@ -172,6 +194,16 @@ EXAMPLES = '''
     admin_password: admin
     host: auth01
     port: 4502
+
+# Wait for all author replication queues before restarting publishers
+- aem_agent:
+    state: drained
+    folder: agents.author
+    wait_timeout: 900
+    admin_user: admin
+    admin_password: admin
+    host: auth01
+    port: 4502
 '''
 
 
@@ -237,8 +269,10 @@ class AEMAgent(object):
 
         self.changed = False
         self.msg = []
+        self.result = {}
 
-        self.get_agent_info()
+        if self.name:
+            self.get_agent_info()
 
         self.trigger_map = {'no_status_update': 'noStatusUpdate',
                             'no_versioning': 'noVersioning',
@@ -587,15 +621,104 @@ class AEMAgent(object):
         else:
             self.msg.append('old password equal to new')
 
+    # --------------------------------------------------------------------------------
+    # state='drained'
+    # --------------------------------------------------------------------------------
+    def drained(self):
+        if self.name:
+            if not self.exists:
+                self.module.fail_json(msg="can't find agent '/etc/replication/%s/%s'" % (self.folder, self.name))
+            agents = [self.name]
+        else:
+            agents = self.list_agents()
+
+        start = time.time()
+        deadline = start + self.module.params['wait_timeout']
+        interval = self.module.params['wait_interval']
+        last = None
+        samples = []
+        drained = 0
+        polls = 0
+        while True:
+            queues, blocked = self.queue_sizes(agents)
+            polls += 1
+            now = time.time()
+            total = sum(queues.values())
+            if samples:
+                drained += max(0, samples[-1][1] - total)
+            # the rate follows the last polls, a queue may grow meanwhile
+            samples = (samples + [(now, total)])[-DRAIN_RATE_WINDOW:]
+            window = now - samples[0][0]
+            rate = max(0, samples[0][1] - total) / window if window > 0 else 0.0
+            self.result.update(queues=queues, drained_items=drained, polls=polls,
+                               drain_secs=now - start, drain_rate=rate,
+                               eta_secs=total / rate if rate else None)
+            if total == 0:
+                break
+            stuck = [name for name in blocked if last is not None and queues[name] >= last[name]]
+            if stuck:
+                self.module.fail_json(msg='replication queue blocked: %s' % ', '.join(
+                    '%s (%d items)' % (name, queues[name]) for name in stuck), **self.result)
+            if time.time() >= deadline:
+                self.module.fail_json(msg='replication queues not drained within %s seconds: %s' % (
+                    self.module.params['wait_timeout'], ', '.join(
+                        '%s (%d items)' % (name, size) for name, size in sorted(queues.items()) if size)),
+                    **self.result)
+            if last is not None and total < sum(last.values()):
+                # shrinking: poll again around a quarter of the time left
+                interval = self.module.params['wait_interval']
+                if self.result['eta_secs'] is not None:
+                    interval = min(max(interval, self.result['eta_secs'] / 4), WAIT_MAX_INTERVAL)
+            elif last is not None:
+                interval = min(interval * 2, WAIT_MAX_INTERVAL)
+            last = queues
+            time.sleep(max(0, min(interval, deadline - time.time())))
+        self.msg.append('%d items drained from %d queues in %.1f seconds' % (
+            self.result['drained_items'], len(agents), self.result['drain_secs']))
+
+    # --------------------------------------------------------------------------------
+    # Enabled agents of the folder
+    # --------------------------------------------------------------------------------
+    def list_agents(self):
+        r = requests.get(self.url + '/etc/replication/%s.2.json' % self.folder, auth=self.auth)
+        if r.status_code != 200:
+            self.module.fail_json(msg='failed to list agents: %s - %s' % (r.status_code, r.text))
+        agents = []
+        for name, node in sorted(r.json().items()):
+            if isinstance(node, dict) and isinstance(node.get('jcr:content'), dict):
+                if node['jcr:content'].get('enabled') in (True, 'true'):
+                    agents.append(name)
+                else:
+                    self.result.setdefault('skipped', []).append(name)
+        return agents
+
+    # --------------------------------------------------------------------------------
+    # Queue size per agent and the blocked agents
+    # --------------------------------------------------------------------------------
+    def queue_sizes(self, agents):
+        queues = {}
+        blocked = []
+        for name in agents:
+            r = requests.get(self.url + '/etc/replication/%s/%s/jcr:content.queue.json' % (self.folder, name),
+                             auth=self.auth)
+            if r.status_code != 200:
+                self.module.fail_json(msg='failed to read queue of %s: %s - %s' % (name, r.status_code, r.text),
+                                      **self.result)
+            data = r.json()
+            queues[name] = len(data.get('queue', []))
+            if data.get('metaData', {}).get('queueStatus', {}).get('isBlocked') and queues[name]:
+                blocked.append(name)
+        return queues, blocked
+
     # --------------------------------------------------------------------------------
     # Return status and msg to Ansible.
     # --------------------------------------------------------------------------------
     def exit_status(self):
         if self.changed:
             msg = ','.join(self.msg)
-            self.module.exit_json(changed=True, msg=msg)
+            self.module.exit_json(changed=True, msg=msg, **self.result)
         else:
-            self.module.exit_json(changed=False)
+            self.module.exit_json(changed=False, **self.result)
 
 
 # --------------------------------------------------------------------------------
@@ -604,9 +727,9 @@ class AEMAgent(object):
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            state=dict(required=True, choices=['present', 'absent', 'enabled', 'disabled', 'password']),
+            state=dict(required=True, choices=['present', 'absent', 'enabled', 'disabled', 'password', 'drained']),
             folder=dict(required=True),
-            name=dict(required=True),
+            name=dict(default=None),
             title=dict(default=None),
             description=dict(default=None),
             transport_uri=dict(default=None),
@@ -629,8 +752,17 @@ def main():
             protocol_version=dict(default=''),
             batch_mode=dict(default=False, type='bool'),
             batch_wait_time=dict(default=''),
-            batch_max_size=dict(default='')
+            batch_max_size=dict(default=''),
+            wait_timeout=dict(default=600, type='int'),
+            wait_interval=dict(default=1, type='float')
         ),
+        required_if=[
+            ['state', 'present', ['name']],
+            ['state', 'absent', ['name']],
+            ['state', 'enabled', ['name']],
+            ['state', 'disabled', ['name']],
+            ['state', 'password', ['name']],
+        ],
         supports_check_mode=True
     )
 
@@ -642,6 +774,8 @@ def main():
         agent.present()
     elif state == 'absent':
         agent.absent()
+    elif state == 'drained':
+        agent.drained()
     else:
         module.fail_json(msg='Invalid state: %s' % state)
 
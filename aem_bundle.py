@@ -5,6 +5,16 @@
 # GNU General Public License v3.0+ (see COPYING or
 # https://www.gnu.org/licenses/gpl-3.0.txt)
 
+import fcntl
+import hashlib
+import json
+import os
+import random
+import re
+import tempfile
+import time
+import uuid
+import zipfile
 import requests
 from ansible.module_utils.basic import *
 
@@ -12,6 +22,10 @@ ANSIBLE_METADATA = {'metadata_version': '1.1',
                     'status': ['preview'],
                     'supported_by': 'community'}
 
+WAIT_MAX_INTERVAL = 15
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+COMPONENT_READY = ('active', 'satisfied')
+
 DOCUMENTATION = u'''
 ---
 module: aem_bundle
@@ -25,12 +39,101 @@ options:
     name:
         description:
             - The name of the bundle
-        required: true
+        required: false
+    names:
+        description:
+            - Symbolic names of several bundles. The bundle list is read
+              once and only the bundles which are not in the desired state
+              get the action. Returns bundles with the state before and
+              the outcome per bundle.
+        required: false
+    pattern:
+        description:
+            - Regular expression searched in the symbolic names, the
+              matching bundles are handled like names
+        required: false
     action:
         description:
-            - start, stop or refresh the Bundle
+            - start, stop, restart (stop and start) or refresh the Bundle.
+              Fragments are never started or stopped.
+            - install uploads the jars and starts them (see start),
+              bundles with the same version and checksum are skipped and
+              packages are refreshed once after all uploads.
+            - all_active waits until all bundles (or the bundles given with
+              names or pattern) are Active or Fragment and the bundle
+              counters did not change between two polls. Returns
+              ready_secs, polls and not_active with the state of every
+              bundle still not running. It also waits for the selected
+              components (see components) to be active (or satisfied,
+              delayed components are only activated when they are used)
+              and returns components_not_active.
+            - enable and disable the selected declarative service
+              components, only the components not in that state are
+              changed.
         required: true
-        choices: [start, stop, refresh]
+        choices: [start, stop, restart, refresh, install, all_active, enable, disable]
+    components:
+        description:
+            - Names of declarative service components for the actions
+              enable, disable and all_active. The components of the
+              bundles given with name, names or pattern (by bundle id) are
+              selected as well; with all_active these also count as ready
+              when they are disabled. Returns components with the state,
+              the bundle and with enable or disable the outcome per
+              component.
+        required: false
+    jars:
+        description:
+            - Local paths of the bundle jars to install with action install.
+              The symbolic name and version are read from the manifest.
+              A jar is skipped when the installed bundle has its version
+              and the checksum recorded in bundle_index on the last upload
+              matches. Returns bundles with version, installed_version,
+              sha256 and outcome (installed, updated or unchanged) per jar.
+        required: false
+    start:
+        description:
+            - Start the bundles after they are installed
+        required: false
+        default: true
+    start_level:
+        description:
+            - Start level of the installed bundles, the framework default
+              when not given
+        required: false
+    refresh_packages:
+        description:
+            - Refresh the packages once after the jars are uploaded, when
+              at least one was uploaded
+        required: false
+        default: true
+    bundle_index:
+        description:
+            - Path of the checksum index on the target host, keyed by url
+              and symbolic name
+        required: false
+        default: ~/.ansible/aem_bundle_index.json
+    verify:
+        description:
+            - After start or stop poll the bundle until it is Active or
+              Resolved. Returns transitions with the bundle, action, final
+              state and secs of every verified action, fails with the last
+              state seen at wait_timeout. A refresh is not verified.
+        required: false
+        default: true
+    wait_timeout:
+        description:
+            - Seconds to wait with action all_active, for a verified start
+              or stop, or with install for the uploaded versions to be
+              listed, before failing
+        required: false
+        default: 300
+    wait_interval:
+        description:
+            - Seconds between the first polls, doubled after every poll up
+              to 15 seconds, with random jitter
+        required: false
+        default: 1
     admin_user:
         description:
             - AEM admin user account name
@@ -62,6 +165,59 @@ EXAMPLES = u'''
     admin_password: pa$$w0rd
     url: https://aem-node.example.com:4502
 
+# Restart all custom bundles in one task
+- aem_bundle:
+    pattern: ^com\\.example\\.
+    action: restart
+    admin_user: admin
+    admin_password: pa$$w0rd
+    url: https://aem-node.example.com:4502
+
+# Hot deploy bundles
+- aem_bundle:
+    action: install
+    jars:
+      - /tmp/core-1.4.2.jar
+      - /tmp/services-1.4.2.jar
+    admin_user: admin
+    admin_password: pa$$w0rd
+    url: https://aem-node.example.com:4502
+
+# Wait for all bundles to be running after a deployment
+- aem_bundle:
+    action: all_active
+    wait_timeout: 600
+    admin_user: admin
+    admin_password: pa$$w0rd
+    url: https://aem-node.example.com:4502
+
+# Readiness gate on bundles and the components serving traffic
+- aem_bundle:
+    action: all_active
+    components:
+      - com.example.core.servlets.SearchServlet
+      - com.example.core.impl.ProductServiceImpl
+    admin_user: admin
+    admin_password: pa$$w0rd
+    url: https://aem-node.example.com:4502
+
+# Enable every component of the custom bundles
+- aem_bundle:
+    action: enable
+    pattern: ^com\\.example\\.
+    admin_user: admin
+    admin_password: pa$$w0rd
+    url: https://aem-node.example.com:4502
+
+# Disable a component
+- aem_bundle:
+    action: disable
+    components:
+      - com.example.core.impl.ImportScheduler
+    admin_user: admin
+    admin_password: pa$$w0rd
+    url: https://aem-node.example.com:4502
+
 # Refresh AEM bundle
 - aem_bundle:
     name: com.day.crx.crxde-support
@@ -72,6 +228,119 @@ EXAMPLES = u'''
 '''
 
 
+class _MultipartStream(object):
+    """
+    File-like multipart/form-data body, the jar is read from disk in
+    chunks while the request is being sent.
+    """
+
+    def __init__(self, fields, file_field, file_path,
+                 chunk_size=UPLOAD_CHUNK_SIZE):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+        self.chunk_size = chunk_size
+        self.bytes_sent = 0
+
+        head = b''
+        for name, value in fields:
+            head += self._part_header(
+                'Content-Disposition: form-data; name="%s"' % name)
+            head += str(value).encode('utf-8') + b'\r\n'
+        head += self._part_header(
+            'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+            'Content-Type: application/java-archive' % (
+                file_field, os.path.basename(file_path)))
+        tail = ('\r\n--%s--\r\n' % self.boundary).encode('ascii')
+
+        self._length = len(head) + os.path.getsize(file_path) + len(tail)
+        self._segments = [('data', head), ('file', file_path), ('data', tail)]
+        self._file = None
+        self._buffer = b''
+        self._offset = 0
+
+    def _part_header(self, headers):
+        return ('--%s\r\n%s\r\n\r\n' % (self.boundary, headers)).encode('utf-8')
+
+    def __len__(self):
+        return self._length
+
+    def _fill(self):
+        kind, segment = self._segments[0]
+        if kind == 'data':
+            self._segments.pop(0)
+            self._buffer = segment
+        else:
+            if self._file is None:
+                self._file = open(segment, 'rb')
+            self._buffer = self._file.read(self.chunk_size)
+            if not self._buffer:
+                self._file.close()
+                self._file = None
+                self._segments.pop(0)
+        self._offset = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.chunk_size
+        while self._offset >= len(self._buffer) and self._segments:
+            self._fill()
+        chunk = self._buffer[self._offset:self._offset + size]
+        self._offset += len(chunk)
+        self.bytes_sent += len(chunk)
+        return chunk
+
+
+def _jar_manifest(file_path):
+    # main attributes of the jar manifest, continuation lines joined
+    with zipfile.ZipFile(file_path) as jar:
+        lines = jar.read('META-INF/MANIFEST.MF').decode('utf-8').splitlines()
+    headers = {}
+    last = None
+    for line in lines:
+        if not line:
+            break
+        if line.startswith(' ') and last:
+            headers[last] += line[1:]
+            continue
+        last, _, value = line.partition(':')
+        headers[last] = value.strip()
+    return headers
+
+
+def _file_sha256(file_path, chunk_size=UPLOAD_CHUNK_SIZE):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as jar_file:
+        for chunk in iter(lambda: jar_file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _index_load(index_path):
+    try:
+        with open(index_path) as index_file:
+            return json.load(index_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _index_update(index_path, url, entries):
+    # load, modify and save the index under an exclusive lock
+    index_dir = os.path.dirname(index_path) or '.'
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    with open(index_path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            index = _index_load(index_path)
+            index.setdefault(url, {}).update(entries)
+            fd, tmp_path = tempfile.mkstemp(dir=index_dir)
+            with os.fdopen(fd, 'w') as index_file:
+                json.dump(index, index_file, indent=2, sort_keys=True)
+            os.rename(tmp_path, index_path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
 class AEMBundle(object):
     """docstring for AEMBundle"""
 
@@ -79,13 +348,18 @@ class AEMBundle(object):
         # super(AEMBundle, self).__init__()
         self.module = arg
         self.name = self.module.params['name']
+        self.names = self.module.params['names']
+        self.pattern = self.module.params['pattern']
         self.action = self.module.params['action']
         self.admin_user = self.module.params['admin_user']
         self.admin_password = self.module.params['admin_password']
         self.url = self.module.params['url']
         self.changed = False
         self.msg = []
-        self._get_bnd_status()
+        self.result = {}
+        self.bundles = {}
+        if self.name and self.action in ('start', 'stop', 'restart', 'refresh'):
+            self._get_bnd_status()
 
     def _get_bnd_status(self):
         aem_request = requests.get('%s/system/console/bundles/%s.json' %
@@ -94,41 +368,370 @@ class AEMBundle(object):
                                          self.admin_password))
         if aem_request.status_code == 200:
             self.exists = True
-            if aem_request.json()['data'][0]['state'] == 'Active':
+            bundle = aem_request.json()['data'][0]
+            if bundle['state'] == 'Active':
                 self.active = True
             else:
                 self.active = False
+            self.fragment = bool(bundle.get('fragment')) or bundle['state'] == 'Fragment'
         else:
             self.exists = False
             self.active = False
+            self.fragment = False
 
-    def do_action(self):
+    def _get_bundles(self):
+        # all bundles with a single request, by symbolic name
+        aem_request = requests.get('%s/system/console/bundles.json' %
+                                   self.url,
+                                   auth=(self.admin_user,
+                                         self.admin_password))
+        if aem_request.status_code != 200:
+            self.module.fail_json(
+                msg='failed to list bundles - %s' % aem_request.status_code)
+        self.bundles = dict((bundle['symbolicName'], bundle)
+                            for bundle in aem_request.json()['data'])
+
+    def _selected(self, name):
+        # bundle given with name, names or pattern
+        return name == self.name or name in (self.names or []) or \
+            bool(self.pattern and re.search(self.pattern, name))
+
+    def _select_bundles(self):
+        selected = []
+        for name in (self.names or []) + ([self.name] if self.name else []):
+            if name not in self.bundles:
+                self.module.fail_json(msg="can't find bundle '%s'" % (name))
+            selected.append(name)
+        if self.pattern:
+            pattern = re.compile(self.pattern)
+            selected.extend(sorted(name for name in self.bundles
+                                   if pattern.search(name) and name not in selected))
+        return selected
+
+    def _actions(self, active):
+        # console actions needed to reach the desired state
+        if self.action == 'start':
+            return [] if active else ['start']
+        if self.action == 'stop':
+            return ['stop'] if active else []
+        if self.action == 'restart':
+            return ['stop', 'start'] if active else ['start']
+        return [self.action]
+
+    def do_action(self, name=None, action=None):
+        name = name or self.name
+        action = action or self.action
         aem_request = requests.post(
             '%s/system/console/bundles/%s' %
-            (self.url, self.name), data={
-                'action': self.action}, auth=(
+            (self.url, name), data={
+                'action': action}, auth=(
                 self.admin_user, self.admin_password))
         if aem_request.status_code != 200:
             self.module.fail_json(
                 msg='failed to perform %s action on %s bundle - %s' %
-                (self.action, aem_request.status_code, aem_request.json()))
+                (action, name, aem_request.status_code),
+                **self.result)
         self.changed = True
         self.msg.append(
             'action %s was performmed on bundle %s' %
-            (self.action, self.name))
+            (action, name))
+        if self.module.params['verify'] and action in ('start', 'stop'):
+            self._wait_state(name, action)
 
-    def apply_task(self):
-        if self.exists:
-            if self.action == 'start':
-                if not self.active:
-                    self.do_action()
+    def _bundle_state(self, name):
+        try:
+            aem_request = requests.get('%s/system/console/bundles/%s.json' %
+                                       (self.url, name),
+                                       auth=(self.admin_user,
+                                             self.admin_password))
+            if aem_request.status_code != 200:
+                return 'HTTP %s' % aem_request.status_code
+            return aem_request.json()['data'][0]['state']
+        except (requests.exceptions.RequestException, ValueError,
+                KeyError, IndexError) as e:
+            return str(e)
 
-            elif self.action == 'stop':
-                if self.active:
-                    self.do_action()
+    def _wait_state(self, name, action):
+        # a 200 only means the action was accepted, poll until the
+        # bundle reached the state with backoff up to wait_timeout
+        target = 'Active' if action == 'start' else 'Resolved'
+        start = time.time()
+        deadline = start + self.module.params['wait_timeout']
+        interval = self.module.params['wait_interval']
+        while True:
+            state = self._bundle_state(name)
+            if state == target:
+                break
+            if time.time() >= deadline:
+                self.module.fail_json(
+                    msg='bundle %s not %s within %s seconds after %s, state %s' % (
+                        name, target, self.module.params['wait_timeout'],
+                        action, state),
+                    changed=True, **self.result)
+            time.sleep(max(0, min(random.uniform(interval / 2, interval),
+                                  deadline - time.time())))
+            interval = min(interval * 2, WAIT_MAX_INTERVAL)
+        self.result.setdefault('transitions', []).append(
+            {'bundle': name, 'action': action, 'state': state,
+             'secs': time.time() - start})
 
-            else:
-                self.do_action()
+    def apply_bulk(self):
+        self._get_bundles()
+        outcomes = {'start': 'started', 'stop': 'stopped',
+                    'restart': 'restarted', 'refresh': 'refreshed'}
+        self.result['bundles'] = {}
+        for name in self._select_bundles():
+            bundle = self.bundles[name]
+            result = {'state': bundle['state'], 'outcome': 'unchanged'}
+            self.result['bundles'][name] = result
+            if bundle.get('fragment') and self.action != 'refresh':
+                result['outcome'] = 'fragment'
+                continue
+            actions = self._actions(bundle['state'] == 'Active')
+            for action in actions:
+                self.do_action(name, action)
+            if actions:
+                result['outcome'] = outcomes[self.action]
+        done = [name for name, result in self.result['bundles'].items()
+                if result['outcome'] == outcomes[self.action]]
+        self.msg = ['action %s was performmed on %d of %d bundles' % (
+            self.action, len(done), len(self.result['bundles']))]
+
+    def _bundle_states(self):
+        # status counters and the selected bundles not running yet,
+        # no counters while the console is not available
+        try:
+            aem_request = requests.get('%s/system/console/bundles.json' %
+                                       self.url,
+                                       auth=(self.admin_user,
+                                             self.admin_password))
+            if aem_request.status_code != 200:
+                return None, {'console': aem_request.status_code}
+            data = aem_request.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return None, {'console': str(e)}
+        self.bundles = dict((bundle['symbolicName'], bundle)
+                            for bundle in data['data'])
+        selectors = self.name or self.names or self.pattern
+        not_active = dict((name, 'Missing') for name in
+                          (self.names or []) + ([self.name] if self.name else [])
+                          if name not in self.bundles)
+        for name, bundle in self.bundles.items():
+            if selectors and not self._selected(name):
+                continue
+            if bundle['state'] not in ('Active', 'Fragment'):
+                not_active[name] = bundle['state']
+        return data.get('s'), not_active
+
+    def _get_components(self):
+        # all SCR components with a single request, by component name
+        aem_request = requests.get('%s/system/console/components.json' %
+                                   self.url,
+                                   auth=(self.admin_user,
+                                         self.admin_password))
+        if aem_request.status_code != 200:
+            self.module.fail_json(
+                msg='failed to list components - %s' % aem_request.status_code)
+        self.components = dict((component['name'], component)
+                               for component in aem_request.json().get('data', []))
+
+    def _select_components(self, bundle_names):
+        # {component name: bundle}, the given components and the
+        # components of the bundles, matched by bundle id
+        selected = dict((name, None) for name in self.module.params['components'] or [])
+        bundle_ids = dict((self.bundles[name]['id'], name) for name in bundle_names)
+        for name, component in sorted(self.components.items()):
+            if component.get('bundleId') in bundle_ids:
+                selected.setdefault(name, bundle_ids[component['bundleId']])
+        return selected
+
+    def _component_states(self):
+        # the selected components not ready yet, the bundles are the
+        # ones read by the last _bundle_states
+        try:
+            self._get_components()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return {'console': str(e)}
+        bundle_names = []
+        if self.name or self.names or self.pattern:
+            bundle_names = [name for name in self.bundles if self._selected(name)]
+        not_active = {}
+        self.result['components'] = {}
+        for name, bundle in self._select_components(bundle_names).items():
+            state = self.components.get(name, {}).get('state', 'missing')
+            self.result['components'][name] = {'state': state, 'bundle': bundle}
+            ready = COMPONENT_READY if bundle is None else COMPONENT_READY + ('disabled',)
+            if state not in ready:
+                not_active[name] = state
+        return not_active
+
+    def apply_components(self):
+        bundle_names = []
+        if self.name or self.names or self.pattern:
+            self._get_bundles()
+            bundle_names = self._select_bundles()
+        self._get_components()
+        self.result['components'] = {}
+        for name, bundle in sorted(self._select_components(bundle_names).items()):
+            if name not in self.components:
+                self.module.fail_json(msg="can't find component '%s'" % (name),
+                                      **self.result)
+            state = self.components[name]['state']
+            result = {'state': state, 'bundle': bundle, 'outcome': 'unchanged'}
+            self.result['components'][name] = result
+            if (state != 'disabled') == (self.action == 'enable'):
+                continue
+            aem_request = requests.post(
+                '%s/system/console/components/%s' % (self.url, name),
+                data={'action': self.action},
+                auth=(self.admin_user, self.admin_password))
+            if aem_request.status_code != 200:
+                self.module.fail_json(
+                    msg='failed to %s component %s - %s' % (
+                        self.action, name, aem_request.status_code),
+                    changed=self.changed, **self.result)
+            self.changed = True
+            result['outcome'] = self.action + 'd'
+        done = [name for name, result in self.result['components'].items()
+                if result['outcome'] != 'unchanged']
+        self.msg = ['%d of %d components %sd' % (
+            len(done), len(self.result['components']), self.action)]
+
+    # ----------------------------------------------------------------
+    # Wait until all bundles are running and the counters are stable.
+    # Polls with exponential backoff and jitter up to wait_timeout.
+    # ----------------------------------------------------------------
+
+    def wait_all_active(self):
+        start = time.time()
+        deadline = start + self.module.params['wait_timeout']
+        interval = self.module.params['wait_interval']
+        last = None
+        polls = 0
+        while True:
+            counters, not_active = self._bundle_states()
+            polls += 1
+            self.result['not_active'] = not_active
+            if self.module.params['components'] or self.name or self.names or self.pattern:
+                self.result['components_not_active'] = self._component_states()
+                not_active = dict(not_active, **self.result['components_not_active'])
+            if counters is not None and counters == last and not not_active:
+                break
+            last = counters
+            if time.time() >= deadline:
+                self.module.fail_json(
+                    msg='not active within %s seconds: %s' % (
+                        self.module.params['wait_timeout'],
+                        ', '.join('%s (%s)' % (name, state) for name, state
+                                  in sorted(not_active.items())) or 'counters still changing'),
+                    polls=polls, **self.result)
+            time.sleep(max(0, min(random.uniform(interval / 2, interval),
+                                  deadline - time.time())))
+            interval = min(interval * 2, WAIT_MAX_INTERVAL)
+        self.result['ready_secs'] = time.time() - start
+        self.result['polls'] = polls
+
+    # ----------------------------------------------------------------
+    # Install or update bundles from local jars. The bundle list is
+    # read once, unchanged jars are skipped, the uploads are followed
+    # by a single refresh of the packages.
+    # ----------------------------------------------------------------
+
+    def install_jars(self):
+        self._get_bundles()
+        index_path = os.path.expanduser(self.module.params['bundle_index'])
+        indexed = _index_load(index_path).get(self.url, {})
+        self.result['bundles'] = {}
+        uploaded = {}
+        for jar_path in self.module.params['jars']:
+            try:
+                manifest = _jar_manifest(jar_path)
+            except (IOError, OSError, KeyError, zipfile.BadZipfile) as e:
+                self.module.fail_json(msg='failed to read manifest of %s - %s' % (jar_path, e),
+                                      **self.result)
+            if 'Bundle-SymbolicName' not in manifest:
+                self.module.fail_json(msg='%s is not a bundle' % jar_path, **self.result)
+            name = manifest['Bundle-SymbolicName'].split(';')[0].strip()
+            version = manifest.get('Bundle-Version', '0.0.0')
+            installed = self.bundles.get(name)
+            result = {'path': jar_path, 'version': version,
+                      'installed_version': installed['version'] if installed else None,
+                      'sha256': _file_sha256(jar_path)}
+            self.result['bundles'][name] = result
+            entry = {'version': version, 'sha256': result['sha256']}
+            if installed and installed['version'] == version and indexed.get(name) == entry:
+                result['outcome'] = 'unchanged'
+                continue
+            self._upload(jar_path)
+            result['outcome'] = 'updated' if installed else 'installed'
+            uploaded[name] = entry
+        if not uploaded:
+            return
+        self.changed = True
+        _index_update(index_path, self.url, uploaded)
+        self._wait_versions(dict((name, entry['version'])
+                                 for name, entry in uploaded.items()))
+        if self.module.params['refresh_packages']:
+            self._refresh_packages()
+        self.msg = ['%d of %d bundles uploaded' % (
+            len(uploaded), len(self.result['bundles']))]
+
+    def _upload(self, jar_path):
+        fields = [('action', 'install')]
+        if self.module.params['start']:
+            fields.append(('bundlestart', 'start'))
+        if self.module.params['start_level'] is not None:
+            fields.append(('bundlestartlevel', self.module.params['start_level']))
+        body = _MultipartStream(fields, 'bundlefile', jar_path)
+        aem_request = requests.post('%s/system/console/bundles' % self.url,
+                                    data=body,
+                                    headers={'Content-Type': body.content_type},
+                                    auth=(self.admin_user,
+                                          self.admin_password))
+        if aem_request.status_code not in (200, 302):
+            self.module.fail_json(
+                msg='failed to install %s - %s' % (jar_path, aem_request.status_code),
+                **self.result)
+        self.result['bytes_sent'] = self.result.get('bytes_sent', 0) + body.bytes_sent
+
+    def _refresh_packages(self):
+        aem_request = requests.post('%s/system/console/bundles' % self.url,
+                                    data={'action': 'refreshPackages'},
+                                    auth=(self.admin_user,
+                                          self.admin_password))
+        if aem_request.status_code != 200:
+            self.module.fail_json(
+                msg='failed to refresh packages - %s' % aem_request.status_code,
+                changed=True, **self.result)
+        self.result['refreshed'] = True
+
+    def _wait_versions(self, versions):
+        # the console installs in the background, the packages are
+        # refreshed once the uploaded versions are listed
+        deadline = time.time() + self.module.params['wait_timeout']
+        interval = self.module.params['wait_interval']
+        while True:
+            self._get_bundles()
+            pending = sorted(name for name, version in versions.items()
+                             if self.bundles.get(name, {}).get('version') != version)
+            if not pending:
+                return
+            if time.time() >= deadline:
+                self.module.fail_json(
+                    msg='bundles not installed within %s seconds: %s' % (
+                        self.module.params['wait_timeout'], ', '.join(pending)),
+                    changed=True, **self.result)
+            time.sleep(max(0, min(random.uniform(interval / 2, interval),
+                                  deadline - time.time())))
+            interval = min(interval * 2, WAIT_MAX_INTERVAL)
+
+    def apply_task(self):
+        if self.exists:
+            if self.fragment and self.action != 'refresh':
+                # fragments are never started or stopped, as in apply_bulk
+                return
+            for action in self._actions(self.active):
+                self.do_action(action=action)
 
         else:
             self.module.fail_json(msg="can't find bundle '%s'" % (self.name))
@@ -136,22 +739,39 @@ class AEMBundle(object):
     def show_message(self):
         if self.changed:
             msg = ','.join(self.msg)
-            self.module.exit_json(changed=True, msg=msg)
+            self.module.exit_json(changed=True, msg=msg, **self.result)
         else:
-            self.module.exit_json(changed=False)
+            self.module.exit_json(changed=False, **self.result)
 
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            name=dict(required=True, type='str'),
+            name=dict(type='str'),
+            names=dict(type='list'),
+            pattern=dict(type='str'),
             action=dict(
                 default='start',
                 type='str',
                 choices=[
                     'start',
                     'stop',
-                    'refresh']),
+                    'restart',
+                    'refresh',
+                    'install',
+                    'all_active',
+                    'enable',
+                    'disable']),
+            components=dict(type='list'),
+            verify=dict(default=True, type='bool'),
+            jars=dict(type='list'),
+            start=dict(default=True, type='bool'),
+            start_level=dict(type='int'),
+            refresh_packages=dict(default=True, type='bool'),
+            bundle_index=dict(default='~/.ansible/aem_bundle_index.json',
+                              type='path'),
+            wait_timeout=dict(default=300, type='int'),
+            wait_interval=dict(default=1, type='float'),
             admin_user=dict(required=True, type='str'),
             admin_password=dict(required=True, type='str', no_log=True),
             url=dict(required=True, type='str')
@@ -159,8 +779,34 @@ def main():
         supports_check_mode=False
     )
 
+    if module.params['action'] == 'install':
+        if not module.params['jars']:
+            module.fail_json(msg='jars is required with action install')
+    elif module.params['action'] in ('enable', 'disable'):
+        if not any(module.params[p] for p in ('components', 'name', 'names', 'pattern')):
+            module.fail_json(msg='one of the following is required with action %s: '
+                             'components, name, names, pattern' % module.params['action'])
+    elif module.params['action'] != 'all_active' and not any(
+            module.params[p] for p in ('name', 'names', 'pattern')):
+        module.fail_json(msg='one of the following is required: name, names, pattern')
+
+    if module.params['pattern']:
+        try:
+            re.compile(module.params['pattern'])
+        except re.error as e:
+            module.fail_json(msg="invalid pattern '%s': %s" % (module.params['pattern'], e))
+
     bundle = AEMBundle(module)
-    bundle.apply_task()
+    if module.params['action'] == 'all_active':
+        bundle.wait_all_active()
+    elif module.params['action'] == 'install':
+        bundle.install_jars()
+    elif module.params['action'] in ('enable', 'disable'):
+        bundle.apply_components()
+    elif module.params['name']:
+        bundle.apply_task()
+    else:
+        bundle.apply_bulk()
     bundle.show_message()
 
 
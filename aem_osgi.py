@@ -7,14 +7,32 @@
 # https://www.gnu.org/licenses/gpl-3.0.txt)
 
 
+import hashlib
+import json
+import os
 import re
+import tempfile
+import threading
+import time
 import requests
 import yaml
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 # --------------------------
 # Ansible boiler plate code.
 # --------------------------
 from ansible.module_utils.basic import *
 
+WAIT_MAX_INTERVAL = 15
+# component states which count as running again
+COMPONENT_READY = ('active', 'satisfied')
+TEMPORARY_PID = '%5BTemporary%20PID%20replaced%20by%20real%20PID%20upon%20save%5D'
+# factory instances created by the web console are named <factory pid>.<uuid>
+FACTORY_INSTANCE = re.compile(
+    r'^(.*)\.[a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12}$')
+
 DOCUMENTATION = '''
 ---
 module: aem_osgi
@@ -29,6 +47,9 @@ author: Daniel Siechniewicz / nullDowntime Ltd / daniel@nulldowntime.com modifie
 notes:
     - This module manages bolean, string, array, appending to array and
       factory type settings.
+    - Factory instances are looked up in a snapshot of all configurations
+      read once from /system/console/configMgr/*.json, or from
+      Configurations.txt when the console does not provide it.
       Deletion (which only makes sense for factory type) is not yet
       implemented.
             id             = dict(required=True),
@@ -44,13 +65,16 @@ notes:
 options:
     id:
         description:
-            - The AEM OSGI setting ID
-        required: true
+            - The AEM OSGI setting ID. Required unless configs is used.
+        required: false
     state:
         description:
-            - Create or delete the group
+            - Create or delete the group. C(drift) compares configs with
+              every host of urls (or url) without changing anything and
+              returns hosts with the differences per host, drifted_hosts
+              and failed_hosts.
         required: true
-        choices: [present, absent]
+        choices: [present, absent, drift]
        # ABSENT NOT IMPLEMENTED
 
     property:
@@ -74,8 +98,66 @@ options:
         required: true
     url:
         description:
-            - Host:Port  that Adobe AEM is listening on
-        required: true
+            - Host:Port  that Adobe AEM is listening on. Required unless
+              urls is used.
+        required: false
+    urls:
+        description:
+            - List of Host:Port checked with state drift
+        required: false
+    parallel:
+        description:
+            - Number of hosts checked at the same time with state drift
+        required: false
+        default: 10
+    wait:
+        description:
+            - Wait until the changed configurations are read back with the
+              new values and the components using them are active (or
+              satisfied) again. Returns converged_secs and polls. Requires
+              url, also with install_dir.
+        required: false
+        default: false
+    wait_timeout:
+        description:
+            - Seconds to wait for the changes to be applied before failing
+        required: false
+        default: 300
+    wait_interval:
+        description:
+            - Seconds before the first check, doubled after every check up
+              to 15 seconds
+        required: false
+        default: 1
+    configs:
+        description:
+            - Mapping of OSGI ID to a dict with osgimode (string, array,
+              arrayappend or factory, default string) and properties.
+              The configurations are read once, only changed IDs are
+              posted, one request per ID. id, property, value and
+              osgimode are ignored. Only state present is supported.
+              Returns configs with the unchanged, updated and created IDs
+              and the secs spent on each. A factory ID may be given as
+              factoryPid~name to create several instances of a factory.
+        required: false
+    config_path:
+        description:
+            - Write configs as sling:OsgiConfig nodes below this
+              repository path (for example /apps/myapp/config) instead of
+              using the web console. The existing nodes are read once and
+              all changed ones are written with a single Sling POST
+              import. Factory nodes are named factoryPid-name, the name
+              defaults to a hash of the values. arrayappend is not
+              supported.
+        required: false
+    install_dir:
+        description:
+            - Write configs as .cfg.json files into this directory on the
+              target host, usually crx-quickstart/install, without any
+              HTTP request. Factory files are named factoryPid~name.cfg.json.
+              Unchanged files are not rewritten. arrayappend is not
+              supported.
+        required: false
 '''
 
 EXAMPLES = '''
@@ -147,9 +229,258 @@ EXAMPLES = '''
          admin_password: testtest
          url: http://aem-node.example.com:4502
 
+# Bootstrap the baseline through the file installer
+     - aem_osgi:
+         configs: "{{ osgi_baseline }}"
+         install_dir: /opt/aem/author/crx-quickstart/install
+         state: present
+         admin_user: admin
+         admin_password: testtest
+
+# Report the hosts which differ from the baseline
+     - aem_osgi:
+         configs: "{{ osgi_baseline }}"
+         state: drift
+         urls: "{{ groups['aem'] | map('regex_replace', '^(.*)$', 'http://\\1:4502') | list }}"
+         admin_user: admin
+         admin_password: testtest
+
+# Apply a whole baseline in one task
+     - aem_osgi:
+         configs:
+           com.adobe.cq.cdn.rewriter.impl.CDNRewriter:
+             properties:
+               service.ranking: "5"
+               cdnrewriter.attributes: [python, perl]
+           org.apache.sling.commons.log.LogManager.factory.config:
+             osgimode: factory
+             properties:
+               org.apache.sling.commons.log.level: debug
+               org.apache.sling.commons.log.file: logs/standby.log
+         state: present
+         admin_user: admin
+         admin_password: testtest
+         url: http://aem-node.example.com:4502
+
 '''
 
 
+# ----------------------------------------------------------------------
+# Parse a Configurations.txt dump in a single pass. A block starts with a
+# "PID = " line and contains every "key = value" line up to the next one.
+# Returns {pid: properties} and {factory pid: {instance pid: properties}}.
+# ----------------------------------------------------------------------
+def parse_configurations(lines):
+    configs = {}
+    block = None
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        key, sep, value = line.partition('=')
+        if not sep:
+            continue
+        key = key.strip()
+        if key == 'PID' and not line[:1].isspace():
+            block = configs[value.strip()] = {}
+        if block is not None:
+            block[key] = value.strip()
+
+    factories = {}
+    for pid, props in configs.items():
+        factory_pid = props.get('Factory PID')
+        if not factory_pid:
+            instance = FACTORY_INSTANCE.match(pid)
+            factory_pid = instance.group(1) if instance else None
+        if factory_pid:
+            factories.setdefault(factory_pid, {})[pid] = props
+    return configs, factories
+
+
+# -----------------------------------------------------------------
+# Normalize a configuration value, lists to lists of strings and any
+# other value to its string, booleans and numbers the way OSGi prints
+# them. Values of the text dump are read as "[a, b]" for lists.
+# -----------------------------------------------------------------
+def normalize_value(value, text=False):
+    if text and value.startswith('[') and value.endswith(']'):
+        value = [v.strip() for v in value[1:-1].split(',')] if value[1:-1].strip() else []
+    if isinstance(value, (list, tuple)):
+        return [normalize_value(v) for v in value]
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if value is None:
+        return ''
+    return str(value)
+
+
+# ------------------------------------------------------------------
+# Canonical form of a property set projected onto keys, used as the
+# hash key of factory instances. Values are normalized and trimmed, a
+# single value list equals the value itself (the console stores one
+# value of a property without metatype as a plain string), booleans
+# are case insensitive, missing keys are None.
+# ------------------------------------------------------------------
+def canonical_value(value):
+    value = normalize_value(value)
+    if isinstance(value, list):
+        value = tuple(canonical_value(v) for v in value)
+        return value[0] if len(value) == 1 else value
+    value = value.strip()
+    return value.lower() if value.lower() in ('true', 'false') else value
+
+
+def canonical_key(props, keys):
+    return tuple(canonical_value(props[k]) if k in props else None
+                 for k in keys)
+
+
+def canonical_props(props):
+    return dict((k, canonical_value(v)) for k, v in props.items()
+                if not k.startswith('jcr:'))
+
+
+class OsgiError(Exception):
+    pass
+
+
+def created_pid(response, factory_pid):
+    # PID of a new factory instance from the redirect of the console
+    if response is None:
+        return None
+    for r in list(response.history) + [response]:
+        for location in (r.headers.get('Location'), r.url):
+            pid = (location or '').rstrip('/').rsplit('/', 1)[-1]
+            if pid.startswith(factory_pid + '.'):
+                return pid
+    return None
+
+
+# ----------------------------------------------------------------------
+# Snapshot of the OSGi configurations of an instance. All configurations
+# are fetched once as JSON from the web console and indexed by PID and
+# factory PID, the Configurations.txt dump is the fallback. A PID which is
+# not in the snapshot is fetched on its own, a written PID is invalidated
+# and a created factory instance is added to its factory, so writes do not
+# cause the whole snapshot to be read again. Without a module errors are
+# raised as OsgiError.
+# ----------------------------------------------------------------------
+class OsgiSnapshot(object):
+    def __init__(self, module, url, auth):
+        self.module = module
+        self.url = url
+        self.auth = auth
+        self.loaded = False
+        self.text = False
+        self.configs = {}
+        self.factories = {}
+        self.indexes = {}
+        self.stale = set()
+
+    def load(self):
+        self.configs = {}
+        self.factories = {}
+        self.indexes = {}
+        self.stale = set()
+        self.loaded = True
+        if self.text:
+            return self.load_text()
+        r = requests.get('%s/system/console/configMgr/*.json' % self.url,
+                         auth=self.auth)
+        try:
+            configs = r.json() if r.status_code == 200 else None
+        except ValueError:
+            configs = None
+        if not isinstance(configs, list) or not all(
+                'properties' in config for config in configs):
+            # console without the JSON listing, use the dump from now on
+            self.text = True
+            return self.load_text()
+        for config in configs:
+            pid = config.get('pid')
+            self.configs[pid] = config
+            if config.get('factoryPid'):
+                self.factories.setdefault(config['factoryPid'], {})[pid] = dict(
+                    (k, normalize_value(v.get('values', v.get('value'))))
+                    for k, v in config['properties'].items())
+        return self
+
+    def load_text(self):
+        r = requests.get(
+            '%s/system/console/config/Configurations.txt' % self.url,
+            auth=self.auth, stream=True)
+        if r.status_code != 200:
+            self.fail('Requests failed\
+            =%s output=%s' % (r.status_code, r.text))
+        configs, factories = parse_configurations(
+            r.iter_lines(chunk_size=64 * 1024))
+        for factory_pid, instances in factories.items():
+            self.factories[factory_pid] = dict(
+                (pid, dict((k, normalize_value(v, text=True))
+                           for k, v in props.items()))
+                for pid, props in instances.items())
+        return self
+
+    def get(self, pid):
+        # configuration of pid with the properties as the console returns
+        # them, metatype defaults included
+        if pid not in self.configs:
+            r = requests.post(
+                '%s/system/console/configMgr/%s' % (self.url, pid),
+                auth=self.auth)
+            if r.status_code != 200:
+                self.fail('Error searching for osgi id. status\
+                =%s output=%s' % (r.status_code, r.text))
+            self.configs[pid] = r.json()
+        return self.configs[pid]
+
+    def factory(self, factory_pid):
+        # {instance pid: normalized properties} of a factory
+        if not self.loaded or factory_pid in self.stale:
+            self.load()
+        return self.factories.get(factory_pid, {})
+
+    def factory_index(self, factory_pid, keys):
+        # {canonical key: [instance pid]} of a factory for the key set,
+        # built once per key set and kept until the factory is reloaded
+        instances = self.factory(factory_pid)
+        keys = tuple(sorted(keys))
+        if (factory_pid, keys) not in self.indexes:
+            index = {}
+            for pid, props in instances.items():
+                index.setdefault(canonical_key(props, keys), []).append(pid)
+            self.indexes[(factory_pid, keys)] = index
+        return self.indexes[(factory_pid, keys)]
+
+    def invalidate(self, pid):
+        # forget a written configuration or instance, a factory PID is
+        # read again on the next lookup, the rest is kept
+        self.configs.pop(pid, None)
+        self.stale.add(pid)
+        for factory_pid, instances in self.factories.items():
+            if instances.pop(pid, None) is not None:
+                self.drop_indexes(factory_pid)
+
+    def add(self, factory_pid, pid, values):
+        # a created factory instance with the posted values, the console
+        # does not always tell the new PID, a local one is used then
+        if not self.loaded:
+            return
+        instances = self.factories.setdefault(factory_pid, {})
+        if pid is None:
+            pid = '%s.created-%d' % (factory_pid, len(instances))
+        instances[pid] = dict((k, normalize_value(v)) for k, v in values.items())
+        self.drop_indexes(factory_pid)
+
+    def drop_indexes(self, factory_pid):
+        for key in [key for key in self.indexes if key[0] == factory_pid]:
+            del self.indexes[key]
+
+    def fail(self, msg):
+        if self.module is None:
+            raise OsgiError(msg)
+        self.module.fail_json(msg=msg)
+
+
 # -------------
 # AEMOsgi class.
 # -------------
@@ -159,7 +490,9 @@ class AEMOsgi(object):
         self.state = self.module.params['state']
         self.id = self.module.params['id']
         self.property = self.module.params['property']
-        self.value = yaml.load(self.module.params['value'])
+        self.value = None
+        if self.module.params['value'] is not None:
+            self.value = yaml.safe_load(self.module.params['value'])
         self.osgimode = self.module.params['osgimode']
         self.admin_user = self.module.params['admin_user']
         self.admin_password = self.module.params['admin_password']
@@ -171,7 +504,12 @@ class AEMOsgi(object):
         self.msg = []
         self.factory_instances = []
         self.curr_props = []
-        self.get_osgi_info()
+        self.configs = self.module.params['configs']
+        self.result = {}
+        self.written = []
+        self.snapshot = OsgiSnapshot(self.module, self.url, self.auth)
+        if not self.configs:
+            self.get_osgi_info()
         self.exists = False
         self.factory = []
 
@@ -181,14 +519,9 @@ class AEMOsgi(object):
     def get_osgi_info(self):
         if self.osgimode in ('string', 'array', 'arrayappend'):
 
-            r = requests.post(
-                '%s/system/console/configMgr/%s' % (self.url, self.id),
-                auth=self.auth)
-
-            if r.status_code != 200:
-                self.module.fail_json(msg='Error searching for osgi id. status\
-                =%s output=%s' % (r.status_code, r.text))
-            info = r.json()
+            # the snapshot is not loaded for a single ID, get() posts for
+            # this PID alone, which is cheaper than reading every config
+            info = self.snapshot.get(self.id)
             self.curr_props = info['properties']
             if self.curr_props[self.property]:
                 self.exists = True
@@ -204,85 +537,84 @@ class AEMOsgi(object):
     # Find factory config
     # -------------------
     def find_factory(self):
-        r = requests.get(
-            '%s/system/console/config/Configurations.txt' % self.url,
-            auth=self.auth)
-        if r.status_code != 200:
-            self.module.fail_json(msg='Requests failed\
-            =%s output=%s' % (r.status_code, r.text))
-
-        instances = re.findall(
-            '^PID.*=.*(%s\.[a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12})\s*$' % self.id,
-            r.text, flags=re.M)
-        if instances:
-            # Instances of a factory found
-            factories = {}
-            for fi in instances:
-                factory_data = re.findall('(PID = %s.*?)\n^PID' % fi, r.text,
-                                          flags=re.DOTALL | re.M)
-                factory = {}
-                for kvp in factory_data[0].splitlines():
-                    (k, v) = kvp.strip().split('=')
-                    factory[k.strip()] = v.strip()
-                factories[fi] = factory
-            self.factory_instances = factories
-            return True
-        else:
-            return False
+        self.factory_instances = self.snapshot.factory(self.id)
+        return bool(self.factory_instances)
 
     # ----------------------------------------------------------
     # Check if factory values already match an existing instance
     # ----------------------------------------------------------
     def find_factory_match(self):
-        f_match = 0
-        factory = ''
-        for f, d in self.factory_instances.items():
-            v_match = 0
-            for k, v in self.value.items():
-                if isinstance(v, int):
-                    v = str(v)
-                # Lists are returned from Configurations.txt without surround\
-                # ing quotes
-                if isinstance(v, list):
-                    v = str(v).replace("'", "")
-                if v == d[k]:
-                    v_match += 1
-            if v_match == len(self.value.keys()):
-                f_match += 1
-                factory = f
-
-        if f_match == 0:
+        factory = self.match_factory(self.snapshot, self.id, self.value)
+        if factory is None:
             return False
-        elif f_match == 1:
-            self.factory = factory
-            return True
-        else:
+        self.factory = factory
+        return True
+
+    def factory_matches(self, snapshot, factory_pid, value):
+        keys = sorted(value)
+        index = snapshot.factory_index(factory_pid, keys)
+        return index.get(canonical_key(value, keys), [])
+
+    def match_factory(self, snapshot, factory_pid, value):
+        matches = self.factory_matches(snapshot, factory_pid, value)
+        if len(matches) > 1:
             self.module.fail_json(
                 msg='Factory %s matches more than one existing factories, this\
-                 SHOULD not happen' % self.id)
+                 SHOULD not happen' % factory_pid)
+        return matches[0] if matches else None
 
-    # ---------------------
-    # Create factory config
-    # ---------------------
-    def create_factory(self):
+    # -----------------------------------------
+    # Fields of a new factory instance and of a
+    # configuration update.
+    # -----------------------------------------
+    def factory_fields(self, factory_pid, value):
         fields = []
-        if self.module.check_mode:
-            return
-
         fields.append(('apply', 'true'))
         fields.append(('action', 'ajaxConfigManager'))
-        fields.append(('factoryPid', self.id))
-        for k, v in self.value.items():
+        fields.append(('factoryPid', factory_pid))
+        for k, v in value.items():
+            v = normalize_value(v)
             if isinstance(v, list):
                 for vv in v:
                     fields.append((k, vv))
             else:
                 fields.append((k, v))
-        fields.append(('propertylist', ','.join(self.value.keys())))
+        fields.append(('propertylist', ','.join(value.keys())))
+        return fields
+
+    def update_fields(self, curr_props, values, append=False):
+        fields = []
+        fields.append(('apply', 'true'))
+        fields.append(('action', 'ajaxConfigManager'))
+        for i in curr_props.keys():
+            valueflag = 'value'
+            if "values" in curr_props[i].keys():
+                valueflag = 'values'
+            value = curr_props[i][valueflag]
+            if i in values:
+                if append:
+                    value = list(value) if isinstance(value, list) else [value]
+                    value = value + [v for v in values[i] if v not in value]
+                else:
+                    value = values[i]
+            fields.append((i, value))
+        # properties without metatype are added
+        added = [i for i in values if i not in curr_props]
+        for i in added:
+            fields.append((i, values[i]))
+        fields.append(('propertylist', ','.join(map(str, list(curr_props.keys()) + added))))
+        return fields
+
+    # ---------------------
+    # Create factory config
+    # ---------------------
+    def create_factory(self):
+        if self.module.check_mode:
+            return
 
         r = requests.post(
-            self.url + '/system/console/configMgr/%5BTemporary%20PID%20replaced%20by%20real%20PID%20upon%20save%5D',
-            auth=self.auth, data=fields)
+            self.url + '/system/console/configMgr/' + TEMPORARY_PID,
+            auth=self.auth, data=self.factory_fields(self.id, self.value))
 
         if r.status_code != 200:
             self.module.fail_json(
@@ -291,8 +623,9 @@ class AEMOsgi(object):
                                                               r.text))
 
         self.changed = True
-        self.find_factory()
-        self.find_factory_match()
+        self.written.append((self.id, self.value, 'factory'))
+        self.factory = created_pid(r, self.id) or self.id
+        self.snapshot.add(self.id, created_pid(r, self.id), self.value)
         self.msg.append('factory %s created' % self.factory)
 
     # ---------------------
@@ -314,6 +647,7 @@ class AEMOsgi(object):
                                       (self.factory, r.status_code, r.text))
 
         self.changed = True
+        self.snapshot.invalidate(self.factory)
         self.msg.append('factory %s deleted' % self.factory)
 
     # ---------------
@@ -331,9 +665,8 @@ class AEMOsgi(object):
                 self.create_factory()
         else:
             do_update = False
-            if type(self.curr_props[self.property][
-                self.modevalue.get(self.osgimode)]) not in (
-                    int, bool, str, unicode):
+            if isinstance(self.curr_props[self.property][
+                    self.modevalue.get(self.osgimode)], list):
                 current = sorted(self.curr_props[self.property][
                     self.modevalue.get(self.osgimode)])
             else:
@@ -381,31 +714,14 @@ class AEMOsgi(object):
     # Update property
     # ----------------
     def update_property(self):
-        fields = []
         if self.osgimode not in ['string', 'array', 'arrayappend', 'factory']:
             self.module.fail_json(
                 msg='Currently only string, array, arrayappend and factory mo\
                 des are supported')
-        allpropertylist = ','.join(map(str, self.curr_props.keys()))
         if not self.module.check_mode:
-            fields.append(('apply', 'true'))
-            fields.append(('action', 'ajaxConfigManager'))
-            for i in self.curr_props.keys():
-                valueflag = 'value'
-                if "values" in self.curr_props[i].keys():
-                    valueflag = 'values'
-                value = self.curr_props[i][valueflag]
-                if i == self.property:
-                    if self.osgimode == 'arrayappend':
-                        for new_item_value in self.value:
-                            if new_item_value not in value:
-                                value.append(new_item_value)
-#                        value.extend(self.value)
-                    else:
-                        value = self.value
-                fields.append((i, value))
-
-            fields.append(('propertylist', allpropertylist))
+            fields = self.update_fields(self.curr_props,
+                                        {self.property: self.value},
+                                        self.osgimode == 'arrayappend')
             r = requests.post(
                 '%s/system/console/configMgr/%s' % (self.url, self.id),
                 auth=self.auth, data=fields)
@@ -415,14 +731,340 @@ class AEMOsgi(object):
                     msg='failed to update property %s in %s: %s - %s' % (
                         self.property, self.id, r.status_code, r.text))
             self.changed = True
+            self.written.append((self.id, {self.property: self.value},
+                                 self.osgimode))
+            self.snapshot.invalidate(self.id)
             self.msg.append('property updated')
 
+    # ------------------------------------------------------------
+    # Apply a mapping of PID to configuration. The live state is
+    # read once, only the changed PIDs are posted, one POST each.
+    # ------------------------------------------------------------
+    def apply_configs(self):
+        if self.state != 'present':
+            self.module.fail_json(msg='configs supports only state present')
+        start = time.time()
+        self.snapshot.load()
+        result = {'unchanged': [], 'updated': [], 'created': [], 'secs': {}}
+        self.result['configs'] = result
+        for pid, config in sorted(self.configs.items()):
+            pid_start = time.time()
+            mode = config.get('osgimode', 'string')
+            values = config.get('properties') or {}
+            if mode not in ('string', 'array', 'arrayappend', 'factory'):
+                self.module.fail_json(
+                    msg='osgimode %s of %s not recognized' % (mode, pid))
+            if mode == 'factory':
+                factory_pid = pid.partition('~')[0]
+                if self.match_factory(self.snapshot, factory_pid, values) is not None:
+                    result['unchanged'].append(pid)
+                else:
+                    r = self.post_config(TEMPORARY_PID,
+                                         self.factory_fields(factory_pid, values),
+                                         factory_pid)
+                    self.snapshot.add(factory_pid, created_pid(r, factory_pid), values)
+                    self.written.append((factory_pid, values, mode))
+                    result['created'].append(pid)
+            else:
+                curr_props = self.snapshot.get(pid)['properties']
+                changed = dict((k, v) for k, v in values.items()
+                               if self.property_changed(curr_props.get(k), v, mode))
+                if not changed:
+                    result['unchanged'].append(pid)
+                else:
+                    self.post_config(pid, self.update_fields(
+                        curr_props, changed, mode == 'arrayappend'), pid)
+                    self.written.append((pid, changed, mode))
+                    result['updated'].append(pid)
+            result['secs'][pid] = time.time() - pid_start
+        result['total_secs'] = time.time() - start
+        self.changed = bool(result['updated'] or result['created'])
+        self.msg.append('%d configurations updated, %d created, %d unchanged' % (
+            len(result['updated']), len(result['created']),
+            len(result['unchanged'])))
+
+    # -------------------------------------------------------------------
+    # configs as installer resources, {name: (pid, factory pid, values)}.
+    # A factory configuration may be keyed factoryPid~name, without a
+    # name the hash of its values is used.
+    # -------------------------------------------------------------------
+    def config_resources(self, separator):
+        if self.state != 'present':
+            self.module.fail_json(msg='configs supports only state present')
+        resources = {}
+        for pid, config in sorted(self.configs.items()):
+            mode = config.get('osgimode', 'string')
+            values = config.get('properties') or {}
+            if mode not in ('string', 'array', 'factory'):
+                self.module.fail_json(
+                    msg='osgimode %s of %s is not supported with config_path or install_dir' % (mode, pid))
+            factory_pid = None
+            name = pid
+            if mode == 'factory':
+                factory_pid, _, alias = pid.partition('~')
+                if not alias:
+                    alias = hashlib.sha1(repr(canonical_key(
+                        values, sorted(values))).encode('utf-8')).hexdigest()[:8]
+                name = factory_pid + separator + alias
+            resources[name] = (pid, factory_pid, values)
+        return resources
+
+    # ----------------------------------------------------------------
+    # Write configs as sling:OsgiConfig nodes below config_path. The
+    # existing nodes are read first, the changed ones are written in a
+    # single Sling POST import.
+    # ----------------------------------------------------------------
+    def import_configs(self):
+        start = time.time()
+        config_path = '/' + self.module.params['config_path'].strip('/')
+        resources = self.config_resources('-')
+        result = {'unchanged': [], 'updated': [], 'created': []}
+        self.result['configs'] = result
+
+        r = requests.get('%s%s.1.json' % (self.url, config_path), auth=self.auth)
+        if r.status_code == 404:
+            nodes = {}
+        elif r.status_code == 200:
+            nodes = r.json()
+        else:
+            self.module.fail_json(msg='failed to read %s: %s - %s' % (
+                config_path, r.status_code, r.text))
+
+        content = {}
+        for name, (pid, factory_pid, values) in sorted(resources.items()):
+            node = nodes.get(name)
+            if isinstance(node, dict) and canonical_props(node) == canonical_props(values):
+                result['unchanged'].append(pid)
+                continue
+            content[name] = dict(values, **{'jcr:primaryType': 'sling:OsgiConfig'})
+            result['updated' if isinstance(node, dict) else 'created'].append(pid)
+            self.written.append((factory_pid or pid, values,
+                                 'factory' if factory_pid else 'string'))
+
+        if content and not self.module.check_mode:
+            r = requests.post(self.url + config_path, auth=self.auth, data={
+                ':operation': 'import', ':contentType': 'json',
+                ':content': json.dumps(content), ':replace': 'true',
+                ':replaceProperties': 'true'})
+            if r.status_code not in (200, 201):
+                self.module.fail_json(msg='failed to import configurations to %s: %s - %s' % (
+                    config_path, r.status_code, r.text), **self.result)
+        result['total_secs'] = time.time() - start
+        self.changed = bool(content)
+        self.msg.append('%d configurations updated, %d created, %d unchanged' % (
+            len(result['updated']), len(result['created']),
+            len(result['unchanged'])))
+
+    # -----------------------------------------------------------------
+    # Write configs as .cfg.json files into install_dir, for example
+    # crx-quickstart/install on the AEM host. No HTTP request is made.
+    # -----------------------------------------------------------------
+    def write_config_files(self):
+        start = time.time()
+        install_dir = self.module.params['install_dir']
+        if not os.path.isdir(install_dir):
+            self.module.fail_json(msg='install_dir %s does not exist' % install_dir)
+        resources = self.config_resources('~')
+        result = {'unchanged': [], 'updated': [], 'created': []}
+        self.result['configs'] = result
+
+        for name, (pid, factory_pid, values) in sorted(resources.items()):
+            path = os.path.join(install_dir, name + '.cfg.json')
+            current = None
+            if os.path.exists(path):
+                try:
+                    with open(path) as config_file:
+                        current = json.load(config_file)
+                except ValueError:
+                    current = None
+            if isinstance(current, dict) and canonical_props(current) == canonical_props(values):
+                result['unchanged'].append(pid)
+                continue
+            result['updated' if os.path.exists(path) else 'created'].append(pid)
+            self.written.append((factory_pid or pid, values,
+                                 'factory' if factory_pid else 'string'))
+            if not self.module.check_mode:
+                # the installer never sees a partly written file
+                fd, tmp_path = tempfile.mkstemp(dir=install_dir, prefix='.' + name)
+                with os.fdopen(fd, 'w') as config_file:
+                    json.dump(values, config_file, indent=2, sort_keys=True)
+                os.chmod(tmp_path, 0o644)
+                os.rename(tmp_path, path)
+        result['total_secs'] = time.time() - start
+        self.changed = bool(result['updated'] or result['created'])
+        self.msg.append('%d configurations updated, %d created, %d unchanged' % (
+            len(result['updated']), len(result['created']),
+            len(result['unchanged'])))
+
+    # ----------------------------------------------------------------
+    # Wait until the written configurations are read back and their
+    # components are running again. Polls with exponential backoff up
+    # to wait_timeout, the first poll after wait_interval.
+    # ----------------------------------------------------------------
+    def wait_applied(self):
+        if not self.written or self.module.check_mode:
+            return
+        start = time.time()
+        deadline = start + self.module.params['wait_timeout']
+        interval = self.module.params['wait_interval']
+        polls = 0
+        while True:
+            time.sleep(max(0, min(interval, deadline - time.time())))
+            polls += 1
+            pending = self.pending_changes()
+            if not pending:
+                break
+            if time.time() >= deadline:
+                self.module.fail_json(
+                    msg='configuration not applied within %s seconds: %s' % (
+                        self.module.params['wait_timeout'], ', '.join(pending)),
+                    changed=self.changed, polls=polls, **self.result)
+            interval = min(interval * 2, WAIT_MAX_INTERVAL)
+        self.result['converged_secs'] = time.time() - start
+        self.result['polls'] = polls
+        self.msg.append('applied after %.1f seconds' % self.result['converged_secs'])
+
+    def pending_changes(self):
+        # written PIDs not read back yet and their components not running
+        pending = []
+        try:
+            for pid, values, mode in self.written:
+                self.snapshot.invalidate(pid)
+                if mode == 'factory':
+                    if not self.factory_matches(self.snapshot, pid, values):
+                        pending.append(pid)
+                    continue
+                curr_props = self.snapshot.get(pid)['properties']
+                if any(self.property_changed(curr_props.get(k), v, mode)
+                       for k, v in values.items()):
+                    pending.append(pid)
+            r = requests.get('%s/system/console/components.json' % self.url,
+                             auth=self.auth)
+            components = r.json().get('data', []) if r.status_code == 200 else []
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return ['console (%s)' % e]
+        pids = set(pid for pid, values, mode in self.written)
+        for component in components:
+            if pids.intersection((component.get('pid'), component.get('name'))) and \
+                    component.get('state') not in COMPONENT_READY:
+                pending.append('%s (%s)' % (component.get('name'),
+                                            component.get('state')))
+        return pending
+
+    # ------------------------------------------------------------
+    # Compare configs with every host of urls concurrently, nothing
+    # is changed. The result has the differences per host.
+    # ------------------------------------------------------------
+    def drift(self):
+        if not self.configs:
+            self.module.fail_json(msg='configs is required with state drift')
+        urls = self.module.params['urls'] or [self.url]
+        start = time.time()
+        hosts = dict((url, {'status': 'pending'}) for url in urls)
+        pending = queue.Queue()
+        for url in urls:
+            pending.put(url)
+
+        def worker():
+            while True:
+                try:
+                    url = pending.get_nowait()
+                except queue.Empty:
+                    return
+                host = hosts[url]
+                host_start = time.time()
+                try:
+                    snapshot = OsgiSnapshot(None, url, self.auth).load()
+                    host['configs'] = self.config_drift(snapshot)
+                    host['status'] = 'drifted' if host['configs'] else 'ok'
+                except (OsgiError, requests.exceptions.RequestException,
+                        ValueError) as e:
+                    host['status'] = 'failed'
+                    host['msg'] = str(e)
+                host['secs'] = time.time() - host_start
+
+        threads = [threading.Thread(target=worker) for _ in range(
+            max(1, min(self.module.params['parallel'], len(urls))))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.result['hosts'] = hosts
+        self.result['total_secs'] = time.time() - start
+        for status in ('drifted', 'failed'):
+            self.result[status + '_hosts'] = sorted(
+                url for url, host in hosts.items() if host['status'] == status)
+        self.msg.append('%d of %d hosts drifted' % (
+            len(self.result['drifted_hosts']), len(hosts)))
+        if self.result['failed_hosts']:
+            self.module.fail_json(msg='drift check failed on %s' % ', '.join(
+                self.result['failed_hosts']), **self.result)
+
+    def config_drift(self, snapshot):
+        # {pid: difference} of the configs which differ on snapshot
+        drifted = {}
+        for pid, config in sorted(self.configs.items()):
+            mode = config.get('osgimode', 'string')
+            values = config.get('properties') or {}
+            if mode == 'factory':
+                factory_pid = pid.partition('~')[0]
+                instances = snapshot.factory(factory_pid)
+                if not self.factory_matches(snapshot, factory_pid, values):
+                    drifted[pid] = {'expected': dict((k, normalize_value(v))
+                                                     for k, v in values.items()),
+                                    'instances': len(instances)}
+                continue
+            curr_props = snapshot.get(pid)['properties']
+            diff = {}
+            for k, v in values.items():
+                if self.property_changed(curr_props.get(k), v, mode):
+                    current = curr_props.get(k)
+                    if current is not None:
+                        current = normalize_value(
+                            current.get('values', current.get('value')))
+                    diff[k] = {'expected': normalize_value(v),
+                               'actual': current}
+            if diff:
+                drifted[pid] = diff
+        return drifted
+
+    def property_changed(self, current, value, mode):
+        if current is None:
+            return True
+        current = normalize_value(current.get('values', current.get('value')))
+        value = normalize_value(value)
+        if mode in ('array', 'arrayappend'):
+            if not isinstance(current, list):
+                current = [current]
+            if not isinstance(value, list):
+                value = [value]
+        if mode == 'arrayappend':
+            return any(v not in current for v in value)
+        if mode == 'array':
+            return sorted(current) != sorted(value)
+        return current != value
+
+    def post_config(self, pid, fields, name):
+        if self.module.check_mode:
+            return None
+        r = requests.post('%s/system/console/configMgr/%s' % (self.url, pid),
+                          auth=self.auth, data=fields)
+        if r.status_code != 200:
+            self.module.fail_json(
+                msg='failed to apply configuration %s: %s - %s' % (
+                    name, r.status_code, r.text), **self.result)
+        if pid != TEMPORARY_PID:
+            self.snapshot.invalidate(name)
+        return r
+
     # ---------------------------------
     # Return status and msg to Ansible.
     # ---------------------------------
     def exit_status(self):
         msg = ','.join(self.msg)
-        self.module.exit_json(changed=self.changed, msg=msg)
+        self.module.exit_json(changed=self.changed, msg=msg, **self.result)
 
 
 # ----------
@@ -431,15 +1073,26 @@ class AEMOsgi(object):
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            id=dict(required=True),
-            state=dict(required=True, choices=['present', 'absent']),
+            id=dict(default=None),
+            state=dict(required=True, choices=['present', 'absent', 'drift']),
             property=dict(default=None),
             value=dict(default=None, type='str'),
             osgimode=dict(default=None),
             admin_user=dict(required=True),
             admin_password=dict(required=True, no_log=True),
-            url=dict(required=True, type='str')
+            url=dict(default=None, type='str'),
+            urls=dict(default=None, type='list'),
+            parallel=dict(default=10, type='int'),
+            wait=dict(default=False, type='bool'),
+            wait_timeout=dict(default=300, type='int'),
+            wait_interval=dict(default=1, type='float'),
+            configs=dict(default=None, type='dict'),
+            config_path=dict(default=None, type='str'),
+            install_dir=dict(default=None, type='path')
         ),
+        required_one_of=[['id', 'configs'], ['url', 'urls', 'install_dir']],
+        mutually_exclusive=[['config_path', 'install_dir']],
+        required_if=[['wait', True, ['url']]],
         supports_check_mode=True
     )
 
@@ -447,14 +1100,26 @@ def main():
 
     state = module.params['state']
 
-    if state == 'present':
+    if state == 'drift':
+        osgi.drift()
+    elif module.params['configs'] and module.params['install_dir']:
+        osgi.write_config_files()
+    elif module.params['configs'] and module.params['config_path']:
+        osgi.import_configs()
+    elif module.params['configs']:
+        osgi.apply_configs()
+    elif state == 'present':
         osgi.present()
     elif state == 'absent':
         osgi.absent()
     else:
         module.fail_json(msg='Invalid state: %s' % state)
 
+    if module.params['wait']:
+        osgi.wait_applied()
+
     osgi.exit_status()
 
 
-main()
+if __name__ == '__main__':
+    main()
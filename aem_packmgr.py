@@ -6,13 +6,51 @@
 # https://www.gnu.org/licenses/gpl-3.0.txt)
 
 
+import email.utils
+import fcntl
+import hashlib
 import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
 import xml.etree.ElementTree as ET
+import zipfile
 import requests
 from ansible.module_utils.basic import *
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
 
 __version__ = '1.0.0'
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_READ_SIZE = 64 * 1024
+INSTALL_LOG_ERRORS = 10
+INSTALL_LOG_ENTRY = re.compile(r'^\s*(?:.*<!\[CDATA\[)?([AUDRE!-])\s+(/[^<(]*)')
+INSTALL_LOG_ACTIONS = {'A': 'added', 'U': 'updated', 'D': 'deleted',
+                       'R': 'replaced', 'E': 'errors', '!': 'errors',
+                       '-': 'unchanged'}
+INSTALL_LOG_STATUS = re.compile(r'<status code="(\d+)">([^<]*)</status>')
+# packmgr install parameters, explicit install_* options override them
+INSTALL_PROFILES = {
+    'default': {},
+    'bulk-content': {'autosave': 10000, 'recursive': False,
+                     'acHandling': 'merge_preserve'},
+    'code-only': {'autosave': 1024, 'recursive': True,
+                  'acHandling': 'overwrite'},
+}
+INSTALL_LOG_MARKUP = re.compile(r'<[^>]*>|&nbsp;')
+# FileVault escapes the namespace of names: _jcr_content is jcr:content
+CONTENT_NAMESPACE = re.compile(r'^_([A-Za-z0-9]+)_(?=.)')
+
 DOCUMENTATION = '''
 ---
 module: aem_packmgr
@@ -21,6 +59,287 @@ author:
 short_description: Manage AEM packages
 description:
   - Manage AEM packages
+options:
+  state:
+    description:
+      - State of the package
+      - C(uploaded) only uploads (stages) the package without installing
+        it, a package already staged with the same checksum is skipped.
+      - C(installed) installs packages staged before with state uploaded.
+        The checksum of the local zip has to match the one recorded at
+        upload time, nothing is transferred.
+      - C(exported) builds the package on AEM (creating it from
+        export_filters first when they are given) and downloads it to
+        export_path.
+      - C(pruned) keeps the pkg_keep newest versions of every group/name
+        (only of pkg_name and pkg_group when they are set) and removes
+        the older ones. The most recently installed version is kept.
+      - C(dryrun) simulates the installation of the package (uploading it
+        first when pkg_path is not on AEM yet) and returns the number of
+        added, updated and deleted paths and the estimated bytes written
+        as facts.
+    required: false
+    default: present
+    choices: [present, absent, uploaded, installed, exported, pruned, dryrun]
+  pkg_name:
+    description:
+      - Name of the package. Read from META-INF/vault/properties.xml of
+        pkg_path when it is not set, group and version are read from
+        there as well so only the exact version is looked up.
+    required: false
+  pkg_path:
+    description:
+      - Path to the package zip on the target host
+    required: false
+  aem_user:
+    description:
+      - AEM admin user account name
+    required: true
+  aem_passwd:
+    description:
+      - AEM admin user account password
+    required: true
+  aem_url:
+    description:
+      - URL of AEM node. Either aem_url or aem_urls is required.
+    required: false
+  aem_urls:
+    description:
+      - List of AEM node URLs to roll the package (or packages) out to.
+        The package is read and hashed once and deployed to the nodes
+        by a pool of parallel workers. Only state present is supported.
+    required: false
+  parallel:
+    description:
+      - Number of nodes deployed at the same time with aem_urls
+    required: false
+    default: 4
+  fail_policy:
+    description:
+      - With fail_fast no new node is started after the first failure,
+        with continue all nodes are deployed and failures are reported
+    required: false
+    default: fail_fast
+    choices: [fail_fast, continue]
+  install_async:
+    description:
+      - Do not hold the install request open for the whole installation.
+        When AEM does not answer within async_wait seconds the request is
+        dropped and the package status is polled until it is unpacked.
+    required: false
+    default: false
+  async_wait:
+    description:
+      - Seconds to wait for the install response with install_async
+    required: false
+    default: 10
+  poll_interval:
+    description:
+      - First interval in seconds between package status polls
+    required: false
+    default: 2
+  poll_backoff:
+    description:
+      - Factor the poll interval is multiplied with after every poll
+    required: false
+    default: 2
+  poll_max_interval:
+    description:
+      - Maximum interval in seconds between package status polls
+    required: false
+    default: 60
+  install_timeout:
+    description:
+      - Seconds to wait for an asynchronous installation
+    required: false
+    default: 3600
+  install_log_errors:
+    description:
+      - Number of install log error lines kept in the result
+    required: false
+    default: 10
+  install_profile:
+    description:
+      - Tuning of the installation. C(bulk-content) saves every 10000
+        nodes, does not install sub packages and merges access control
+        keeping the existing entries. C(code-only) saves every 1024 nodes,
+        installs sub packages and overwrites access control. C(default)
+        sends no tuning parameters.
+    required: false
+    default: default
+    choices: [default, bulk-content, code-only]
+  install_autosave:
+    description:
+      - Number of nodes after which the installation saves, overrides
+        the profile. Larger values mean fewer but bigger transactions.
+    required: false
+  install_recursive:
+    description:
+      - Install the sub packages of the package, overrides the profile
+    required: false
+  install_ac_handling:
+    description:
+      - Access control handling of the installation, overrides the profile
+    required: false
+    choices: [ignore, overwrite, merge, merge_preserve, clear]
+  export_path:
+    description:
+      - Local file the package is downloaded to with state exported. The
+        download is streamed to export_path.part and an interrupted
+        download is resumed from there when the package was not rebuilt
+        in the meantime (export_rebuild false).
+    required: false
+  export_filters:
+    description:
+      - List of filter roots. The package is created when it does not
+        exist and its filter is set to these roots before the build.
+    required: false
+  export_rebuild:
+    description:
+      - Rebuild an existing package before downloading it
+    required: false
+    default: true
+  export_sha256:
+    description:
+      - Expected SHA-256 of the downloaded package. The zip CRCs are
+        always checked.
+    required: false
+  aem_force:
+    description:
+      - Upload and install the package even if it is already present
+    required: false
+    default: false
+  pkg_validate:
+    description:
+      - Run the offline structural checks of the package zip (vault
+        properties and filter, jcr_root, entry paths) before the
+        installation. Nothing is sent to AEM.
+    required: false
+    default: false
+  pkg_validate_remote:
+    description:
+      - Upload the package to cmd=validate of the package manager before
+        the installation. This transfers the package one more time.
+    required: false
+    default: false
+  upload_chunk_size:
+    description:
+      - Size in bytes of the chunks the package is read from disk with
+        while it is uploaded
+    required: false
+    default: 1048576
+  pkg_checksum:
+    description:
+      - Compare the SHA-256 of the local zip with the checksum recorded
+        in pkg_index when the package was deployed. An installed package
+        with the same checksum is skipped, an uploaded but not installed
+        one is installed in place, a changed one is uploaded again.
+        A package present on AEM without an index entry is uploaded
+        again once, its checksum is recorded after the installation.
+    required: false
+    default: true
+  pkg_index:
+    description:
+      - Path of the checksum index on the target host. Entries are keyed
+        by aem_url and group:name:version of the package.
+    required: false
+    default: ~/.ansible/aem_packmgr_index.json
+  pkg_group:
+    description:
+      - Group of the package. With pkg_version only the package with
+        exactly this group:name:version is looked up.
+    required: false
+  pkg_version:
+    description:
+      - Version of the package, see pkg_group
+    required: false
+  pkg_query:
+    description:
+      - Look the package up with the server side filtered list.jsp query
+        instead of the full cmd=ls listing. Falls back to cmd=ls when
+        list.jsp is not available.
+    required: false
+    default: false
+  packages:
+    description:
+      - Ordered list of packages to install in one task, every item is a
+        dict with path and optionally name, group and version. Package
+        N+1 is uploaded while package N is being installed, packages are
+        installed strictly in the list order and the first failure stops
+        the batch. Name, group and version are read from the package
+        when they are not set. pkg_name and pkg_path are ignored.
+    required: false
+  pkg_keep:
+    description:
+      - Number of newest versions kept per group/name with state pruned
+    required: false
+    default: 3
+'''
+
+RETURN = '''
+upload:
+  description:
+    - Upload statistics, C(bytes_sent), C(upload_secs) spent sending
+      request bodies and C(throughput_bps) computed from them
+  returned: always
+  type: dict
+sha256:
+  description:
+    - SHA-256 of the package zip, when it had to be computed
+  returned: when state is present and pkg_checksum is true
+  type: str
+packages:
+  description:
+    - Per package results of a batch with C(status) (installed, skipped,
+      failed), C(upload_secs), C(install_secs) and C(sha256)
+  returned: when packages is set
+  type: list
+total_secs:
+  description:
+    - Wall clock time of the batch or of the rollout
+  returned: when packages or aem_urls is set
+  type: float
+install:
+  description:
+    - Summary of the install log, C(added), C(updated), C(deleted) and
+      C(errors) counters, the first C(error_lines), C(install_secs), the
+      C(profile) and the install C(params) sent and with install_async
+      C(polls) of the package status
+  returned: when a package was installed
+  type: dict
+export:
+  description:
+    - Export results, C(path), C(size), C(sha256), C(bytes_received),
+      C(download_secs), C(resumed_from) when a download was resumed and
+      the build log summary
+  returned: when state is exported
+  type: dict
+dryrun:
+  description:
+    - Dry run summary with the C(added), C(updated), C(deleted) and
+      C(errors) counters, the first error lines, C(bytes) written
+      (uncompressed content of the added and updated paths, or the
+      written share of the package size without pkg_path) and
+      C(dryrun_secs). Also set as the aem_packmgr_dryrun fact.
+  returned: when state is dryrun
+  type: dict
+pruned:
+  description:
+    - group:name:version of the removed packages
+  returned: when state is pruned
+  type: list
+reclaimed_bytes:
+  description:
+    - Total size of the removed packages
+  returned: when state is pruned
+  type: int
+nodes:
+  description:
+    - Per node results of a rollout with C(status) (ok, changed, failed,
+      pending when not started), C(upload_secs), C(install_secs) and
+      per package C(packages) results
+  returned: when aem_urls is set
+  type: dict
 '''
 EXAMPLES = '''
 # Remove package :
@@ -41,50 +360,473 @@ EXAMPLES = '''
         aem_passwd: admin
         aem_url: http://auth01:4502
 
-# Validate package before Upload and install
+# Validate package on AEM before Upload and install
 # https://helpx.adobe.com/experience-manager/6-4/sites/
 # administering/using/package-manager.html :
 
     - aem_packmgr:
         state: present
         pkg_name: test-all
+        pkg_validate_remote: true
+        pkg_path: /home/vagrant/test-all-2.2-SNAPSHOT.zip
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Upload a big package reading it from disk in 4MB chunks, the result
+# contains bytes sent and upload throughput:
+    - aem_packmgr:
+        state: present
+        pkg_name: content-all
+        pkg_path: /home/vagrant/content-all-1.0.zip
+        upload_chunk_size: 4194304
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Checksums of uploaded packages are kept in a local index (pkg_index)
+# keyed by aem_url. A package with the same SHA-256 which is already
+# installed is skipped, an uploaded but not installed one is installed
+# in place without sending it again:
+    - aem_packmgr:
+        state: present
+        pkg_name: test-all
+        pkg_path: /home/vagrant/test-all-2.2-SNAPSHOT.zip
+        pkg_index: /var/lib/aem/packmgr_index.json
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Name, group and version are read from the package, offline checks of
+# the package structure are done before the upload:
+    - aem_packmgr:
+        state: present
         pkg_validate: true
         pkg_path: /home/vagrant/test-all-2.2-SNAPSHOT.zip
         aem_user: admin
         aem_passwd: admin
         aem_url: http://auth01:4502
 
+# Install several packages in one task, uploads are pipelined with
+# installations and the install order is kept:
+    - aem_packmgr:
+        state: present
+        packages:
+          - name: core
+            path: /home/vagrant/core-1.0.zip
+          - name: apps
+            path: /home/vagrant/apps-1.0.zip
+          - name: content
+            path: /home/vagrant/content-1.0.zip
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Roll a package out to a publish farm, 5 nodes at a time:
+    - aem_packmgr:
+        state: present
+        pkg_path: /home/vagrant/test-all-2.2-SNAPSHOT.zip
+        aem_urls:
+          - http://publ01:4503
+          - http://publ02:4503
+          - http://publ03:4503
+        parallel: 5
+        fail_policy: continue
+        aem_user: admin
+        aem_passwd: admin
+
+# Install a big content package without holding the request open, the
+# package status is polled with backoff instead:
+    - aem_packmgr:
+        state: present
+        pkg_path: /home/vagrant/content-all-1.0.zip
+        install_async: true
+        poll_interval: 5
+        install_timeout: 7200
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Stage packages on all publishers ahead of the maintenance window:
+    - aem_packmgr:
+        state: uploaded
+        packages:
+          - path: /home/vagrant/core-1.0.zip
+          - path: /home/vagrant/content-1.0.zip
+        aem_urls: "{{ publish_urls }}"
+        aem_user: admin
+        aem_passwd: admin
+
+# ... and install them in the window, without any transfer:
+    - aem_packmgr:
+        state: installed
+        packages:
+          - path: /home/vagrant/core-1.0.zip
+          - path: /home/vagrant/content-1.0.zip
+        aem_urls: "{{ publish_urls }}"
+        aem_user: admin
+        aem_passwd: admin
+
+# Snapshot content before a release:
+    - aem_packmgr:
+        state: exported
+        pkg_name: content-backup
+        pkg_group: backups
+        export_filters:
+          - /content/site
+          - /content/dam/site
+        export_path: /backup/content-backup.zip
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Estimate the impact of a package before the maintenance window:
+    - aem_packmgr:
+        state: dryrun
+        pkg_path: /tmp/my-content-1.0.zip
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+    - debug:
+        msg: "{{ aem_packmgr_dryrun.bytes }} bytes in {{ aem_packmgr_dryrun.added }} new paths"
+
+# Install a large content package with bigger save batches:
+    - aem_packmgr:
+        state: present
+        pkg_path: /tmp/my-content-1.0.zip
+        install_profile: bulk-content
+        install_autosave: 20000
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Keep only the 2 newest versions of every package of a group:
+    - aem_packmgr:
+        state: pruned
+        pkg_group: my_packages
+        pkg_keep: 2
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Look up exactly group:name:version with the server side filtered query:
+    - aem_packmgr:
+        state: present
+        pkg_name: test-all
+        pkg_group: my_packages
+        pkg_version: 2.2-SNAPSHOT
+        pkg_query: true
+        pkg_path: /home/vagrant/test-all-2.2-SNAPSHOT.zip
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
 '''
 
 
-def _pgk_exist(url, login, password, int_pkg_name):
-    response = requests.get(url + '/crx/packmgr/service.jsp?cmd=ls',
-                            auth=(login, password))
-    aem_response = ET.fromstring(response.text)
+class _MultipartStream(object):
+    """
+    File-like multipart/form-data body. Form fields are kept in memory,
+    the uploaded file is read from disk in fixed-size chunks while
+    the request is being sent, so memory usage does not depend on
+    the package size.
+    """
+
+    def __init__(self, fields, file_name, file_path,
+                 chunk_size=UPLOAD_CHUNK_SIZE):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+        self.chunk_size = chunk_size
+        self.bytes_sent = 0
+        self.started = None
+        self.finished = None
+
+        head = b''
+        for name, value in fields:
+            if isinstance(value, bool):
+                value = str(value).lower()
+            head += self._part_header(
+                'Content-Disposition: form-data; name="%s"' % name)
+            head += str(value).encode('utf-8') + b'\r\n'
+        head += self._part_header(
+            'Content-Disposition: form-data; name="file"; filename="%s"\r\n'
+            'Content-Type: application/zip' % file_name)
+        tail = ('\r\n--%s--\r\n' % self.boundary).encode('ascii')
+
+        self._length = len(head) + os.path.getsize(file_path) + len(tail)
+        self._segments = [('data', head), ('file', file_path), ('data', tail)]
+        self._file = None
+        self._buffer = b''
+        self._offset = 0
+
+    def _part_header(self, headers):
+        return ('--%s\r\n%s\r\n\r\n' % (self.boundary, headers)).encode('utf-8')
+
+    def __len__(self):
+        return self._length
+
+    def _fill(self):
+        kind, segment = self._segments[0]
+        if kind == 'data':
+            self._segments.pop(0)
+            self._buffer = segment
+        else:
+            if self._file is None:
+                self._file = open(segment, 'rb')
+            self._buffer = self._file.read(self.chunk_size)
+            if not self._buffer:
+                self._file.close()
+                self._file = None
+                self._segments.pop(0)
+        self._offset = 0
 
-    packages_list = []
-    for package in aem_response.findall('response/data/packages/package/name'):
-        packages_list.append(package.text)
+    def read(self, size=-1):
+        if self.started is None:
+            self.started = time.time()
+        if size is None or size < 0:
+            size = self.chunk_size
+        while self._offset >= len(self._buffer) and self._segments:
+            self._fill()
+        chunk = self._buffer[self._offset:self._offset + size]
+        self._offset += len(chunk)
+        self.bytes_sent += len(chunk)
+        if chunk:
+            self.finished = time.time()
+        return chunk
 
-    download_names = []
-    for elements in aem_response.findall(
-            'response/data/packages/package/downloadName'):
-        download_names.append(elements.text)
+    def elapsed(self):
+        # time spent sending the body, server side processing before
+        # the response is not included
+        if self.started is None or self.finished is None:
+            return 0
+        return self.finished - self.started
 
-    if any(int_pkg_name in x for x in (packages_list, download_names)):
-        print('installed')
+
+def _pkg_upload(url, login, password, file_name, file_path, query='',
+                values=None, stats=None, chunk_size=UPLOAD_CHUNK_SIZE):
+    # streaming multipart upload, upload statistics are accumulated
+    # into stats when it is given
+    body = _MultipartStream(values or [], file_name, file_path, chunk_size)
+    response = requests.post(url + '/crx/packmgr/service.jsp' + query,
+                             data=body,
+                             headers={'Content-Type': body.content_type},
+                             auth=(login, password))
+    if stats is not None:
+        stats['bytes_sent'] = stats.get('bytes_sent', 0) + body.bytes_sent
+        stats['upload_secs'] = stats.get('upload_secs', 0) + body.elapsed()
+        if stats['upload_secs'] > 0:
+            stats['throughput_bps'] = int(stats['bytes_sent'] / stats['upload_secs'])
+        else:
+            stats['throughput_bps'] = stats['bytes_sent']
+    return response
+
+
+def _pkg_key(info):
+    return '%s:%s:%s' % (info.get('group', ''), info.get('name', ''),
+                         info.get('version', ''))
+
+
+class PackageInventory(object):
+    """
+    Index of the packages present on an AEM instance. The cmd=ls listing
+    is parsed as a stream with iterparse, only a few fields of every
+    package are kept. Lookups by name, download name and exact
+    group:name:version are dict lookups.
+    """
+
+    FIELDS = ('group', 'name', 'version', 'downloadName', 'size', 'created',
+              'lastModified', 'lastUnpacked', 'lastWrapped')
+    DATES = ('created', 'lastModified', 'lastUnpacked', 'lastWrapped')
+
+    def __init__(self, url, login, password, query=None):
+        self.url = url
+        self.auth = (login, password)
+        self.query = query
+        self.loaded = False
+        self.packages = {}
+        self.by_name = {}
+
+    def load(self):
+        self.packages = {}
+        self.by_name = {}
+        if not (self.query and self._load_query()):
+            self._load_ls()
+        self.loaded = True
+        return self
+
+    def _load_ls(self):
+        response = requests.get(self.url + '/crx/packmgr/service.jsp?cmd=ls',
+                                auth=self.auth, stream=True)
+        response.raw.decode_content = True
+        for event, element in ET.iterparse(response.raw):
+            if element.tag == 'package':
+                self.add(dict((field, element.findtext(field) or '')
+                              for field in self.FIELDS))
+                element.clear()
+        response.close()
+
+    def _load_query(self):
+        # server side filtered listing, not available on old AEM versions
+        response = requests.get(self.url + '/crx/packmgr/list.jsp',
+                                params={'q': self.query}, auth=self.auth)
+        if response.status_code != 200:
+            return False
+        try:
+            results = response.json()['results']
+        except (ValueError, KeyError):
+            return False
+        for result in results:
+            self.add(dict((field, self._query_value(field, result.get(field)))
+                          for field in self.FIELDS))
         return True
-    else:
-        print('not installed')
-        return False
+
+    def _query_value(self, field, value):
+        # list.jsp dates are epoch milliseconds, they are kept in the
+        # RFC 822 format of the cmd=ls listing
+        if not value:
+            return ''
+        if field in self.DATES and str(value).isdigit():
+            return email.utils.formatdate(int(value) / 1000.0, localtime=True)
+        return str(value)
+
+    def add(self, info):
+        self.remove(info)
+        self.packages[_pkg_key(info)] = info
+        for name in (info['name'], info['downloadName']):
+            self.by_name.setdefault(name, []).append(info)
+
+    def remove(self, info):
+        old = self.packages.pop(_pkg_key(info), None)
+        if old is not None:
+            for name in (old['name'], old['downloadName']):
+                self.by_name[name] = [pkg for pkg in self.by_name[name]
+                                      if pkg is not old]
+
+    def find(self, pkg_name, group=None, version=None):
+        # all packages matching the name or the download name, there can be
+        # several versions or groups of the same package on the server
+        if not self.loaded:
+            self.load()
+        if group is not None and version is not None:
+            info = self.packages.get(
+                _pkg_key({'group': group, 'name': pkg_name,
+                          'version': version}))
+            return [info] if info else []
+        return [pkg for pkg in self.by_name.get(pkg_name, [])
+                if group is None or pkg['group'] == group]
+
+
+def _pkg_find(inventory, pkg_name, group=None, version=None):
+    return inventory.find(pkg_name, group, version)
+
+
+def _file_sha256(file_path, chunk_size=UPLOAD_CHUNK_SIZE):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as package_file:
+        for chunk in iter(lambda: package_file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _index_load(index_path):
+    # local index of uploaded packages checksums keyed by AEM url and
+    # group:name:version of the package
+    try:
+        with open(index_path) as index_file:
+            return json.load(index_file)
+    except (IOError, OSError, ValueError):
+        return {}
 
 
-def _pkg_validate(url, login, password, file_name, file_path):
+def _index_update(index_path, url, key, entry):
+    # load, modify and save the index under an exclusive lock, several
+    # hosts can be handled from the same machine in parallel
+    index_dir = os.path.dirname(index_path) or '.'
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    with open(index_path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            index = _index_load(index_path)
+            if entry is None:
+                index.get(url, {}).pop(key, None)
+            else:
+                index.setdefault(url, {})[key] = entry
+            fd, tmp_path = tempfile.mkstemp(dir=index_dir)
+            with os.fdopen(fd, 'w') as index_file:
+                json.dump(index, index_file, indent=2, sort_keys=True)
+            os.rename(tmp_path, index_path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _pkg_inspect(file_path):
+    # read the package metadata from the zip central directory and the
+    # vault properties/filter definitions without reading the content
+    package_zip = zipfile.ZipFile(file_path)
+    try:
+        names = package_zip.namelist()
+        inspection = {'entries': len(names),
+                      'content_size': 0,
+                      'names': names,
+                      'filters': [],
+                      'properties': None}
+        for info in package_zip.infolist():
+            if info.filename.startswith('jcr_root/'):
+                inspection['content_size'] += info.file_size
+        if 'META-INF/vault/properties.xml' in names:
+            properties = ET.fromstring(
+                package_zip.read('META-INF/vault/properties.xml'))
+            inspection['properties'] = dict(
+                (entry.get('key'), (entry.text or '').strip())
+                for entry in properties.iter('entry'))
+        if 'META-INF/vault/filter.xml' in names:
+            workspace_filter = ET.fromstring(
+                package_zip.read('META-INF/vault/filter.xml'))
+            inspection['filters'] = [element.get('root') for element
+                                     in workspace_filter.iter('filter')]
+    finally:
+        package_zip.close()
+
+    properties = inspection['properties'] or {}
+    for field in ('name', 'group', 'version'):
+        inspection[field] = properties.get(field, '')
+    return inspection
+
+
+def _pkg_check(inspection):
+    # structural checks which can be done offline, returns problems found
+    problems = []
+    if inspection['properties'] is None:
+        problems.append('META-INF/vault/properties.xml is missing')
+    elif not inspection['name']:
+        problems.append('package name is not defined in properties.xml')
+    if 'META-INF/vault/filter.xml' not in inspection['names']:
+        problems.append('META-INF/vault/filter.xml is missing')
+    elif not inspection['filters']:
+        problems.append('filter.xml does not define any filter root')
+    for root in inspection['filters']:
+        if not root or not root.startswith('/'):
+            problems.append('filter root %s is not an absolute path' % root)
+    if not any(name.startswith('jcr_root/') for name in inspection['names']):
+        problems.append('package does not contain jcr_root')
+    seen = set()
+    for name in inspection['names']:
+        if name.startswith('/') or '..' in name.split('/'):
+            problems.append('unsafe entry path %s' % name)
+        if name in seen:
+            problems.append('duplicate entry %s' % name)
+        seen.add(name)
+    return problems
+
+
+def _pkg_validate(url, login, password, file_name, file_path, stats=None,
+                  chunk_size=UPLOAD_CHUNK_SIZE):
     # validation
-    file = {'file': (file_name, open(file_path, 'rb'), 'application/zip')}
-    response = requests.post(
-        url + '/crx/packmgr/service.jsp?cmd=validate&type=osgiPackageI\
-        mports,overlays,acls', files=file, auth=(login, password))
+    response = _pkg_upload(
+        url, login, password, file_name, file_path,
+        query='?cmd=validate&type=osgiPackageImports,overlays,acls',
+        stats=stats, chunk_size=chunk_size)
     print(response.text)
     aem_response = ET.fromstring(response.text)
     if (aem_response.find("response/status").attrib['code']) == '200':
@@ -93,44 +835,227 @@ def _pkg_validate(url, login, password, file_name, file_path):
         return False
 
 
-def _pkg_install(url, login, password, file_name, file_path, install=False,
-                 strict=True):
-    # uploading
-    files = {'file': (file_name, open(file_path, 'rb'), 'application/zip')}
-    values = {'install': install, 'strict': strict}
-    response = requests.post(url + '/crx/packmgr/service.jsp', files=files,
-                             data=values, auth=(login, password))
+def _pkg_install_log(response, report, max_errors=INSTALL_LOG_ERRORS,
+                     sizes=None, markup=False):
+    # parse the install response line by line, only counters and the
+    # first error lines are kept, returns the response status code. With
+    # sizes (see _pkg_content_sizes) the bytes of the added and updated
+    # paths are summed up, markup strips the html of script.html output.
+    status_code = None
+    for line in response.iter_lines(chunk_size=64 * 1024):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        if markup:
+            line = INSTALL_LOG_MARKUP.sub(' ', line)
+        entry = INSTALL_LOG_ENTRY.match(line)
+        if entry:
+            action = INSTALL_LOG_ACTIONS.get(entry.group(1), 'other')
+            report[action] = report.get(action, 0) + 1
+            if action == 'errors' and len(report['error_lines']) < max_errors:
+                report['error_lines'].append(line.strip())
+            if sizes is not None and action in ('added', 'updated', 'replaced'):
+                report['bytes'] += sizes.get(entry.group(2).strip(), 0)
+        status = INSTALL_LOG_STATUS.search(line)
+        if status:
+            status_code = status.group(1)
+            report['status'] = status.group(2)
+    response.close()
+    return status_code
+
+
+def _pkg_wait(url, login, password, pkg_name, group=None, field='lastUnpacked',
+              previous='', options=None, version=None):
+    # poll the package listing with exponential backoff until field of
+    # the package is set to a new time, returns the number of polls or
+    # None when the deadline has passed. With version only that exact
+    # package counts, another installed version is not a completion.
+    # Times are compared parsed, listings do not share one format.
+    options = options or {}
+    interval = options.get('poll_interval', 2)
+    deadline = time.time() + options.get('install_timeout', 3600)
+    polls = 0
+    while time.time() < deadline:
+        time.sleep(interval)
+        polls += 1
+        try:
+            found = PackageInventory(url, login, password, pkg_name).load().find(
+                pkg_name, group if version is None else (group or ''), version)
+        except (requests.exceptions.RequestException, ET.ParseError):
+            found = []
+        if any(pkg.get(field) and _pkg_time(pkg, field) != _pkg_time({field: previous}, field)
+               for pkg in found):
+            return polls
+        interval = min(interval * options.get('poll_backoff', 2),
+                       options.get('poll_max_interval', 60))
+    return None
+
+
+def _pkg_command(url, login, password, cmd, pkg_name, group=None,
+                 report=None, options=None, previous='', field='lastUnpacked',
+                 values=None, version=None):
+    # run a long service.jsp command (inst, build) on a package, its log is
+    # summarized into report. With options install_async the request is
+    # not held open, field of the package status is polled instead.
+    options = options or {}
+    if report is None:
+        report = {}
+    report.update({'added': 0, 'updated': 0, 'deleted': 0, 'errors': 0,
+                   'error_lines': []})
+    params = {'cmd': cmd, 'name': pkg_name}
+    if group:
+        params['group'] = group
+    start = time.time()
+    try:
+        response = requests.post(
+            url + '/crx/packmgr/service.jsp', params=params, data=values,
+            auth=(login, password), stream=True,
+            timeout=(30, options['async_wait']) if options.get('install_async') else None)
+        status_code = _pkg_install_log(
+            response, report,
+            options.get('install_log_errors', INSTALL_LOG_ERRORS))
+    except requests.exceptions.RequestException as e:
+        timed_out = isinstance(e, requests.exceptions.ReadTimeout)
+        timed_out = timed_out or 'timed out' in str(e)
+        if not (options.get('install_async') and timed_out):
+            raise
+        # the command continues on AEM, wait for the package status
+        report['async'] = True
+        report['polls'] = _pkg_wait(url, login, password, pkg_name, group,
+                                    field, previous, options, version)
+        status_code = '200' if report['polls'] is not None else None
+        if status_code is None:
+            report['status'] = 'timed out waiting for cmd=' + cmd
+    report[cmd + '_secs'] = time.time() - start
+    # if failure aem send status code 500 with responce status 200
+    return status_code == '200'
+
+
+def _pkg_inst_values(profile='default', autosave=None, recursive=None,
+                     ac_handling=None):
+    # packmgr install parameters of a tuning profile
+    values = dict(INSTALL_PROFILES[profile])
+    for name, value in (('autosave', autosave), ('recursive', recursive),
+                        ('acHandling', ac_handling)):
+        if value is not None:
+            values[name] = value
+    return values
+
+
+def _pkg_inst(url, login, password, pkg_name, group=None, report=None,
+              options=None, previous='', version=None):
+    # install package which is already uploaded, with the tuning of
+    # options install_values
+    options = options or {}
+    if report is None:
+        report = {}
+    values = options.get('install_values') or {}
+    installed = _pkg_command(url, login, password, 'inst', pkg_name,
+                             group, report, options, previous,
+                             values=dict((name, str(value).lower())
+                                         for name, value in values.items()),
+                             version=version)
+    report['install_secs'] = report.pop('inst_secs')
+    report['profile'] = options.get('install_profile', 'default')
+    report['params'] = values
+    if installed:
+        print('ok')
+    return installed
+
+
+def _pkg_content_sizes(file_path):
+    # uncompressed size of the package content by repository path, the
+    # .content.xml of a folder is accounted to the folder node itself
+    sizes = {}
+    package_zip = zipfile.ZipFile(file_path)
+    try:
+        for info in package_zip.infolist():
+            if not info.filename.startswith('jcr_root/') or info.filename.endswith('/'):
+                continue
+            names = unquote(info.filename[len('jcr_root'):]).split('/')
+            if names[-1] == '.content.xml':
+                names.pop()
+            path = '/'.join(CONTENT_NAMESPACE.sub(r'\1:', name) for name in names)
+            sizes[path or '/'] = sizes.get(path or '/', 0) + info.file_size
+    finally:
+        package_zip.close()
+    return sizes
+
+
+def _pkg_dryrun(url, login, password, package, report, options=None,
+                sizes=None):
+    # simulate the installation of an uploaded package, nothing is
+    # written. The log is streamed from script.html and summarized into
+    # report like the install log.
+    options = options or {}
+    report.update({'added': 0, 'updated': 0, 'deleted': 0, 'errors': 0,
+                   'error_lines': [], 'bytes': 0})
+    start = time.time()
+    response = requests.post(
+        url + '/crx/packmgr/service/script.html' + _pkg_path(package),
+        params={'cmd': 'dryrun'}, auth=(login, password), stream=True)
+    status_code = response.status_code
+    _pkg_install_log(response, report,
+                     options.get('install_log_errors', INSTALL_LOG_ERRORS),
+                     sizes if sizes is not None else {}, markup=True)
+    report['dryrun_secs'] = time.time() - start
+    if sizes is None:
+        # without the local package the written share of the package
+        # size is the best guess
+        written = report['added'] + report['updated'] + report.get('replaced', 0)
+        total = written + report['deleted'] + report.get('unchanged', 0)
+        report['bytes'] = int(package.get('size') or 0) * written // total if total else 0
+    report['bytes_estimated_from'] = 'package size' if sizes is None else 'content'
+    return status_code == 200
+
+
+def _pkg_upload_package(url, login, password, file_name, file_path,
+                        strict=True, force=False, stats=None,
+                        chunk_size=UPLOAD_CHUNK_SIZE):
+    # upload without installation, returns the uploaded package info.
+    # Nothing is printed, the module output has to stay a single JSON
+    # document; the response of a failed upload is kept in stats error.
+    values = [('install', False), ('strict', strict), ('force', force)]
+    response = _pkg_upload(url, login, password, file_name, file_path,
+                           values=values, stats=stats, chunk_size=chunk_size)
     aem_response = ET.fromstring(response.text)
-    print('uload finished')
     if (aem_response.find("response/status").attrib['code']) == '200':
-        print(response.text)
-        int_pkg_name = aem_response.find("response/data/package/name").text
+        package = aem_response.find("response/data/package")
+        return dict((element.tag, element.text or '') for element in package)
+    if stats is not None:
+        stats['error'] = response.text
+    return None
+
+
+def _pkg_install(url, login, password, file_name, file_path, install=False,
+                 strict=True, force=False, stats=None,
+                 chunk_size=UPLOAD_CHUNK_SIZE, uploaded=None, report=None,
+                 options=None):
+    # uploading, the uploaded package info is stored into uploaded
+    package = _pkg_upload_package(url, login, password, file_name, file_path,
+                                  strict, force, stats, chunk_size)
+    if package is not None:
+        pkg_name = package['name']
+        if uploaded is not None:
+            uploaded.update(package)
         print("testing result")
-        install_status = requests.post(
-            url + '/crx/packmgr/service.jsp?cmd=inst&name=' + int_pkg_name,
-            auth=(login, password))
-        aem_inst_response = ET.fromstring(install_status.text)
-        # if failure aem send status code 500 with responce status 200
-        if (aem_inst_response.find("response/status").attrib['code']) == '200':
-            print('ok')
+        if _pkg_inst(url, login, password, pkg_name, package.get('group'),
+                     report, options, package.get('lastUnpacked', ''),
+                     package.get('version')):
             return True
         else:
-            print(json.dumps({
-                "failed": True,
-                "msg": install_status.text
-            }))
-            _pkg_remove(url, login, password, int_pkg_name)
+            _pkg_remove(url, login, password, pkg_name,
+                        package.get('group'))
             return False
     else:
-        print(json.dumps({
-            "failed": True,
-            "msg": response.text
-        }))
         return False
 
 
-def _pkg_remove(url, login, password, int_pkg_name):
-    response = requests.post(url + '/crx/packmgr/service.jsp?cmd=rm&name=' + int_pkg_name, auth=(login, password))
+def _pkg_remove(url, login, password, pkg_name, group=None):
+    params = {'cmd': 'rm', 'name': pkg_name}
+    if group:
+        params['group'] = group
+    response = requests.post(url + '/crx/packmgr/service.jsp', params=params,
+                             auth=(login, password))
     aem_response = ET.fromstring(response.text)
 
     # if failure aem send status code 500 with responce status 200
@@ -142,18 +1067,412 @@ def _pkg_remove(url, login, password, int_pkg_name):
         return False
 
 
+def _pkg_path(package):
+    # repository path of a package
+    if package.get('group'):
+        return '/etc/packages/%s/%s' % (package['group'], package['downloadName'])
+    return '/etc/packages/%s' % package['downloadName']
+
+
+def _pkg_define(url, login, password, pkg_name, group, version, filters):
+    # create the package definition if needed and set its filter
+    package = {'name': pkg_name, 'group': group or '',
+               'downloadName': pkg_name + ('-' + version if version else '') + '.zip'}
+    response = requests.post(
+        url + '/crx/packmgr/service/.json' + _pkg_path(package),
+        params={'cmd': 'create'},
+        data={'packageName': pkg_name, 'groupName': group or '',
+              'packageVersion': version or ''},
+        auth=(login, password))
+    if response.status_code != 200:
+        return False
+    workspace_filter = [{'root': root, 'rules': []} for root in filters]
+    response = requests.post(
+        url + '/crx/packmgr/update.jsp',
+        data={'path': _pkg_path(package), 'packageName': pkg_name,
+              'groupName': group or '', 'version': version or '',
+              'filter': json.dumps(workspace_filter), '_charset_': 'UTF-8'},
+        auth=(login, password))
+    return response.status_code == 200
+
+
+def _pkg_download(url, login, password, package, file_path,
+                  chunk_size=UPLOAD_CHUNK_SIZE, report=None, resume=True):
+    # stream the package to file_path in chunks, an interrupted transfer
+    # left in file_path.part is resumed with a range request
+    if report is None:
+        report = {}
+    part_path = file_path + '.part'
+    if not resume and os.path.exists(part_path):
+        os.remove(part_path)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+    start = time.time()
+    response = requests.get(url + _pkg_path(package), headers=headers,
+                            auth=(login, password), stream=True)
+    if response.status_code == 206:
+        mode = 'ab'
+        report['resumed_from'] = offset
+    elif response.status_code == 200:
+        mode = 'wb'
+        offset = 0
+    else:
+        response.close()
+        report['status'] = 'download failed with HTTP %s' % response.status_code
+        return False
+    received = 0
+    try:
+        with open(part_path, mode) as part_file:
+            # small network reads, an interrupted read loses at most one
+            for chunk in response.iter_content(DOWNLOAD_READ_SIZE):
+                part_file.write(chunk)
+                received += len(chunk)
+    except requests.exceptions.RequestException as e:
+        report['bytes_received'] = received
+        report['status'] = 'download interrupted, run again to resume: %s' % e
+        return False
+    finally:
+        response.close()
+    report['bytes_received'] = received
+    report['download_secs'] = time.time() - start
+    if package.get('size') and offset + received != int(package['size']):
+        report['status'] = 'downloaded %d bytes, package size is %s' % (
+            offset + received, package['size'])
+        return False
+    os.rename(part_path, file_path)
+    return True
+
+
+def _pkg_verify(file_path, expected_sha256=None, chunk_size=UPLOAD_CHUNK_SIZE):
+    # check the CRC of every zip entry and the sha256 of the whole file,
+    # returns (sha256, problem)
+    try:
+        package_zip = zipfile.ZipFile(file_path)
+        try:
+            bad_entry = package_zip.testzip()
+        finally:
+            package_zip.close()
+    except zipfile.BadZipfile as e:
+        return None, 'downloaded package is not a valid zip: %s' % e
+    if bad_entry is not None:
+        return None, 'CRC check failed for %s' % bad_entry
+    pkg_sha256 = _file_sha256(file_path, chunk_size)
+    if expected_sha256 and expected_sha256.lower() != pkg_sha256:
+        return pkg_sha256, 'sha256 %s does not match expected %s' % (
+            pkg_sha256, expected_sha256)
+    return pkg_sha256, None
+
+
+def _pkg_delete(url, login, password, package):
+    # delete exactly this package version by its repository path
+    response = requests.post(
+        url + '/crx/packmgr/service/.json' + _pkg_path(package),
+        params={'cmd': 'delete'}, auth=(login, password))
+    if response.status_code != 200:
+        return False
+    try:
+        return response.json().get('success', False)
+    except ValueError:
+        return False
+
+
+def _pkg_time(package, field='created'):
+    # time of a listing date field of a package, 0 when unknown
+    parsed = email.utils.parsedate_tz(package.get(field) or '')
+    return email.utils.mktime_tz(parsed) if parsed else 0
+
+
+def _pkg_prune_plan(inventory, keep, pkg_name=None, group=None):
+    # packages to remove so that only the keep newest versions of every
+    # group/name are left. The most recently installed version is never
+    # removed.
+    versions = {}
+    for package in inventory.packages.values():
+        if pkg_name and package['name'] != pkg_name:
+            continue
+        if group and package['group'] != group:
+            continue
+        versions.setdefault((package['group'], package['name']), []).append(package)
+
+    prune = []
+    for packages in versions.values():
+        packages.sort(key=lambda package: (_pkg_time(package), package['version']),
+                      reverse=True)
+        installed = max(packages, key=lambda package: _pkg_time(package, 'lastUnpacked'))
+        for package in packages[keep:]:
+            if package is not installed or not installed.get('lastUnpacked'):
+                prune.append(package)
+    return prune
+
+
+def _pkg_plan(inventory, index_path, pkg_name, pkg_path, group=None,
+              version=None, force=False, checksum=True,
+              chunk_size=UPLOAD_CHUNK_SIZE, pkg_sha256=None):
+    # decide whether the package has to be uploaded, installed in place
+    # or skipped, returns (action, remote package, sha256)
+    remote_pkgs = []
+    if not force:
+        remote_pkgs = _pkg_find(inventory, pkg_name, group, version)
+
+    action = 'upload'
+    target = None
+    if checksum and remote_pkgs:
+        if pkg_sha256 is None:
+            pkg_sha256 = _file_sha256(pkg_path, chunk_size)
+        indexed = _index_load(index_path).get(inventory.url, {})
+        known = [pkg for pkg in remote_pkgs if _pkg_key(pkg) in indexed]
+        for pkg in known:
+            if indexed[_pkg_key(pkg)].get('sha256') == pkg_sha256:
+                target = pkg
+        if target is not None:
+            action = 'skip' if target.get('lastUnpacked') else 'install'
+        # a package present but not deployed through this index yet
+        # (fresh controller, lost index) has an unknown checksum, it is
+        # uploaded once and indexed after the installation
+    elif remote_pkgs:
+        action = 'skip'
+    return action, target, pkg_sha256
+
+
+def _pkg_installed(inventory, index_path, package, pkg_sha256=None,
+                   installed=True):
+    # record a successfully installed (or only uploaded) package in the
+    # inventory and index
+    package = dict((field, package.get(field, ''))
+                   for field in PackageInventory.FIELDS)
+    if installed:
+        package['lastUnpacked'] = time.strftime('%a, %d %b %Y %H:%M:%S %z')
+    inventory.add(package)
+    if pkg_sha256 is not None:
+        _index_update(index_path, inventory.url, _pkg_key(package),
+                      {'sha256': pkg_sha256})
+
+
+def _pkg_batch(inventory, login, password, packages, index_path, force=False,
+               checksum=True, chunk_size=UPLOAD_CHUNK_SIZE, state='present',
+               options=None):
+    # install an ordered list of packages. Uploads run in a separate
+    # thread one package ahead of the installation, so package N+1 is
+    # uploaded while package N is being installed. With state uploaded
+    # packages are only staged, with state installed only packages staged
+    # before with the same checksum are installed and nothing is sent.
+    # Returns per package results and the failure message if any.
+    url = inventory.url
+    if state == 'installed':
+        checksum = True
+    results = []
+    for pkg in packages:
+        action, target, pkg_sha256 = _pkg_plan(
+            inventory, index_path, pkg['name'], pkg['path'], pkg.get('group'),
+            pkg.get('version'), force and state != 'installed', checksum,
+            chunk_size, pkg.get('sha256'))
+        if state == 'uploaded' and action == 'install':
+            # already staged with the same checksum
+            action = 'skip'
+        if state == 'installed':
+            remote_pkgs = _pkg_find(inventory, pkg['name'], pkg.get('group'),
+                                    pkg.get('version'))
+            if action == 'upload':
+                action = 'missing'
+            elif target is None and not any(remote.get('lastUnpacked')
+                                            for remote in remote_pkgs):
+                action = 'missing'
+        results.append({'name': pkg['name'], 'path': pkg['path'],
+                        'action': action, 'target': target,
+                        'sha256': pkg_sha256, 'upload_secs': 0,
+                        'install_secs': 0, 'status': 'pending'})
+
+    uploads = queue.Queue(maxsize=1)
+    stop = threading.Event()
+
+    def uploader():
+        for result in results:
+            if stop.is_set():
+                break
+            if result['action'] == 'upload':
+                stats = {}
+                try:
+                    result['target'] = _pkg_upload_package(
+                        url, login, password, result['name'], result['path'],
+                        force=True, stats=stats, chunk_size=chunk_size)
+                except Exception as e:
+                    # the consumer waits for every result, errors are
+                    # handed over instead of ending the thread
+                    result['target'] = None
+                    result['error'] = str(e)
+                result['upload_secs'] = stats.get('upload_secs', 0)
+                result['bytes_sent'] = stats.get('bytes_sent', 0)
+                if 'error' in stats:
+                    result['error'] = stats['error']
+            uploads.put(result)
+
+    def next_upload():
+        while True:
+            try:
+                return uploads.get(timeout=1)
+            except queue.Empty:
+                if not thread.is_alive():
+                    return None
+
+    thread = threading.Thread(target=uploader)
+    thread.daemon = True
+    thread.start()
+
+    failure = None
+    for _ in results:
+        result = next_upload()
+        if result is None:
+            failure = "Uploading packages stopped unexpectedly"
+            break
+        target = result['target']
+        if result['action'] == 'skip':
+            result['status'] = 'skipped'
+            continue
+        if result['action'] == 'missing':
+            result['status'] = 'failed'
+            failure = ("Package " + result['name'] + " is not staged or its"
+                       " checksum does not match the staged one")
+            break
+        if target is None:
+            result['status'] = 'failed'
+            failure = "Uploading package " + result['name'] + " is failed"
+            if result.get('error'):
+                failure += ": " + result['error']
+            break
+        if checksum and result['sha256'] is None:
+            result['sha256'] = _file_sha256(result['path'], chunk_size)
+        if state == 'uploaded':
+            result['status'] = 'uploaded'
+            _pkg_installed(inventory, index_path, target, result['sha256'],
+                           installed=False)
+            continue
+        result['install'] = {}
+        installed = _pkg_inst(url, login, password, target['name'],
+                              target.get('group'), result['install'], options,
+                              target.get('lastUnpacked', ''), target.get('version'))
+        result['install_secs'] = result['install']['install_secs']
+        if not installed:
+            result['status'] = 'failed'
+            failure = "Installation package " + result['name'] + " is failed"
+            if result['action'] == 'upload':
+                _pkg_remove(url, login, password, target['name'],
+                            target.get('group'))
+            break
+        result['status'] = 'installed'
+        _pkg_installed(inventory, index_path, target,
+                       result['sha256'] if checksum else None)
+
+    if failure is not None:
+        stop.set()
+        # unblock the uploader, it stops before the next upload
+        while thread.is_alive():
+            try:
+                uploads.get(timeout=1)
+            except queue.Empty:
+                pass
+    thread.join()
+    for result in results:
+        result.pop('target')
+    return results, failure
+
+
+def _pkg_rollout(urls, login, password, packages, index_path, force=False,
+                 checksum=True, chunk_size=UPLOAD_CHUNK_SIZE, parallel=4,
+                 fail_fast=True, state='present', options=None):
+    # deploy the same packages to several AEM nodes through a bounded
+    # pool of worker threads, returns per node results
+    nodes = dict((url, {'status': 'pending', 'upload_secs': 0,
+                        'install_secs': 0}) for url in urls)
+    pending = queue.Queue()
+    for url in urls:
+        pending.put(url)
+    stop = threading.Event()
+
+    def worker():
+        while not stop.is_set():
+            try:
+                url = pending.get_nowait()
+            except queue.Empty:
+                return
+            node = nodes[url]
+            try:
+                inventory = PackageInventory(url, login, password)
+                results, failure = _pkg_batch(
+                    inventory, login, password,
+                    [dict(pkg) for pkg in packages], index_path, force,
+                    checksum, chunk_size, state, options)
+            except Exception as e:
+                results, failure = [], str(e)
+            node['packages'] = results
+            node['upload_secs'] = sum(result['upload_secs'] for result in results)
+            node['install_secs'] = sum(result['install_secs'] for result in results)
+            if failure is not None:
+                node['status'] = 'failed'
+                node['msg'] = failure
+                if fail_fast:
+                    stop.set()
+            elif any(result['status'] in ('installed', 'uploaded')
+                     for result in results):
+                node['status'] = 'changed'
+            else:
+                node['status'] = 'ok'
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(parallel, len(urls))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return nodes
+
+
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            state=dict(default='present', choices=['present', 'absent']),
+            state=dict(default='present',
+                       choices=['present', 'absent', 'uploaded', 'installed',
+                                'exported', 'pruned', 'dryrun']),
             pkg_name=dict(type='str'),
             pkg_path=dict(type='str'),
             aem_user=dict(required=True, type='str'),
             aem_passwd=dict(required=True, type='str', no_log=True),
-            aem_url=dict(required=True, type='str'),
+            aem_url=dict(type='str'),
+            aem_urls=dict(type='list'),
+            parallel=dict(default=4, type='int'),
+            fail_policy=dict(default='fail_fast',
+                             choices=['fail_fast', 'continue']),
             aem_force=dict(default='false', type='bool'),
-            pkg_validate=dict(default='false', type='bool')
+            pkg_validate=dict(default='false', type='bool'),
+            upload_chunk_size=dict(default=UPLOAD_CHUNK_SIZE, type='int'),
+            pkg_checksum=dict(default=True, type='bool'),
+            pkg_index=dict(default='~/.ansible/aem_packmgr_index.json',
+                           type='path'),
+            pkg_group=dict(type='str'),
+            pkg_version=dict(type='str'),
+            pkg_query=dict(default=False, type='bool'),
+            packages=dict(type='list'),
+            pkg_validate_remote=dict(default=False, type='bool'),
+            install_async=dict(default=False, type='bool'),
+            async_wait=dict(default=10, type='int'),
+            poll_interval=dict(default=2, type='int'),
+            poll_backoff=dict(default=2, type='float'),
+            poll_max_interval=dict(default=60, type='int'),
+            install_timeout=dict(default=3600, type='int'),
+            install_log_errors=dict(default=INSTALL_LOG_ERRORS, type='int'),
+            install_profile=dict(default='default',
+                                 choices=sorted(INSTALL_PROFILES)),
+            install_autosave=dict(type='int'),
+            install_recursive=dict(type='bool'),
+            install_ac_handling=dict(choices=['ignore', 'overwrite', 'merge',
+                                              'merge_preserve', 'clear']),
+            export_path=dict(type='path'),
+            export_filters=dict(type='list'),
+            export_rebuild=dict(default=True, type='bool'),
+            export_sha256=dict(type='str'),
+            pkg_keep=dict(default=3, type='int')
         ),
+        required_one_of=[['aem_url', 'aem_urls']],
         supports_check_mode=False
     )
 
@@ -167,37 +1486,283 @@ def main():
     message = "no changes"
     pkg_name = module.params.get('pkg_name')
     pkg_path = module.params.get('pkg_path')
+    upload_chunk_size = module.params.get('upload_chunk_size')
+    pkg_checksum = module.params.get('pkg_checksum')
+    pkg_index = module.params.get('pkg_index')
+    pkg_group = module.params.get('pkg_group')
+    pkg_version = module.params.get('pkg_version')
+    packages = module.params.get('packages')
+    aem_urls = module.params.get('aem_urls')
+    pkg_validate_remote = module.params.get('pkg_validate_remote')
+    pkg_sha256 = None
+    upload_stats = {}
+    install_report = {}
+    install_options = dict((option, module.params.get(option)) for option in (
+        'install_async', 'async_wait', 'poll_interval', 'poll_backoff',
+        'poll_max_interval', 'install_timeout', 'install_log_errors',
+        'install_profile'))
+    install_options['install_values'] = _pkg_inst_values(
+        module.params.get('install_profile'),
+        module.params.get('install_autosave'),
+        module.params.get('install_recursive'),
+        module.params.get('install_ac_handling'))
+
+    # name, group and version are read from the package itself, so the
+    # existence check matches the exact version which is deployed
+    if packages:
+        items = packages
+    elif pkg_path:
+        items = [{'name': pkg_name, 'path': pkg_path, 'group': pkg_group,
+                  'version': pkg_version}]
+    else:
+        items = []
+    for pkg in items:
+        if not isinstance(pkg, dict) or not pkg.get('path'):
+            module.fail_json(msg="every item of packages needs a path: %s" % pkg)
+        try:
+            inspection = _pkg_inspect(pkg['path'])
+        except (IOError, OSError, zipfile.BadZipfile, ET.ParseError) as e:
+            module.fail_json(msg="can't read package %s: %s" % (pkg['path'], e))
+        if pkg_validate:
+            problems = _pkg_check(inspection)
+            if problems:
+                module.fail_json(msg="validation of  package " + pkg['path'] + " is failed",
+                                 problems=problems)
+        if not pkg.get('name'):
+            pkg['name'] = inspection['name']
+        if pkg['name'] == inspection['name']:
+            for field in ('group', 'version'):
+                if not pkg.get(field):
+                    pkg[field] = inspection[field]
+        if not pkg.get('name'):
+            module.fail_json(msg="can't find name of package %s" % pkg['path'])
+    if items and not packages:
+        pkg_name = items[0]['name']
+        pkg_group = items[0]['group']
+        pkg_version = items[0]['version']
+    if not pkg_name and not packages and state not in ['pruned']:
+        module.fail_json(msg="pkg_name or pkg_path is required")
 
-    if state in ['present'] and (
-            aem_force or not _pgk_exist(aem_url, aem_user, aem_passwd,
-                                        pkg_name)):
+    # the listing is fetched once per run and kept up to date locally
+    inventory = PackageInventory(aem_url, aem_user, aem_passwd,
+                                 pkg_name if module.params.get('pkg_query') else None)
 
-        if pkg_validate and not _pkg_validate(aem_url, aem_user, aem_passwd,
-                                              pkg_name, pkg_path):
-            message = "validation of  package " + pkg_name + " is failed"
-            module.fail_json(msg=message)
+    if state in ['pruned']:
+        pkg_keep = module.params.get('pkg_keep')
+        if pkg_keep < 1:
+            module.fail_json(msg="pkg_keep has to be at least 1")
+        pruned = []
+        reclaimed = 0
+        indexed = _index_load(pkg_index).get(aem_url, {})
+        for package in _pkg_prune_plan(inventory.load(), pkg_keep, pkg_name,
+                                       pkg_group):
+            if not _pkg_delete(aem_url, aem_user, aem_passwd, package):
+                module.fail_json(msg="Removing package %s is failed" % _pkg_key(package),
+                                 changed=bool(pruned), pruned=pruned,
+                                 reclaimed_bytes=reclaimed)
+            inventory.remove(package)
+            if _pkg_key(package) in indexed:
+                _index_update(pkg_index, aem_url, _pkg_key(package), None)
+            pruned.append(_pkg_key(package))
+            reclaimed += int(package.get('size') or 0)
+        module.exit_json(changed=bool(pruned), pruned=pruned,
+                         reclaimed_bytes=reclaimed,
+                         msg="%d packages pruned" % len(pruned))
 
-        if _pkg_install(aem_url, aem_user, aem_passwd, pkg_name, pkg_path):
+    if state in ['dryrun']:
+        remote_pkgs = _pkg_find(inventory, pkg_name, pkg_group, pkg_version)
+        if pkg_path:
+            action, target, pkg_sha256 = _pkg_plan(
+                inventory, pkg_index, pkg_name, pkg_path, pkg_group,
+                pkg_version, aem_force, pkg_checksum, upload_chunk_size)
+            if action == 'upload':
+                remote_pkgs = []
+            elif target is not None:
+                remote_pkgs = [target]
+            if not remote_pkgs:
+                # the dry run needs the package on AEM, it is staged
+                uploaded = _pkg_upload_package(aem_url, aem_user, aem_passwd,
+                                               pkg_name, pkg_path, force=True,
+                                               stats=upload_stats,
+                                               chunk_size=upload_chunk_size)
+                if uploaded is None:
+                    module.fail_json(msg="Uploading package " + pkg_name + " is failed",
+                                     upload=upload_stats)
+                if pkg_checksum and pkg_sha256 is None:
+                    pkg_sha256 = _file_sha256(pkg_path, upload_chunk_size)
+                _pkg_installed(inventory, pkg_index, uploaded,
+                               pkg_sha256 if pkg_checksum else None,
+                               installed=False)
+                remote_pkgs = [uploaded]
+                state_changed = True
+        if len(remote_pkgs) != 1:
+            module.fail_json(msg="Expected one package %s on AEM, found %d" % (
+                pkg_name, len(remote_pkgs)))
+        report = {}
+        if not _pkg_dryrun(aem_url, aem_user, aem_passwd, remote_pkgs[0], report,
+                           install_options,
+                           _pkg_content_sizes(pkg_path) if pkg_path else None):
+            module.fail_json(msg="Dry run of package " + pkg_name + " is failed",
+                             dryrun=report, upload=upload_stats)
+        module.exit_json(changed=state_changed, dryrun=report, upload=upload_stats,
+                         ansible_facts={'aem_packmgr_dryrun': report},
+                         msg="Dry run of package " + pkg_name + " was successful")
 
+    if state in ['exported']:
+        export_path = module.params.get('export_path')
+        export_filters = module.params.get('export_filters')
+        if not pkg_name or not export_path:
+            module.fail_json(msg="pkg_name and export_path are required with state exported")
+        report = {}
+        if export_filters and not _pkg_define(aem_url, aem_user, aem_passwd,
+                                              pkg_name, pkg_group, pkg_version,
+                                              export_filters):
+            module.fail_json(msg="Defining package " + pkg_name + " is failed")
+        remote_pkgs = _pkg_find(inventory, pkg_name, pkg_group, pkg_version)
+        if len(remote_pkgs) != 1:
+            module.fail_json(msg="Expected one package %s on AEM, found %d" % (
+                pkg_name, len(remote_pkgs)))
+        package = remote_pkgs[0]
+        rebuild = export_filters or module.params.get('export_rebuild')
+        if rebuild or not package.get('lastWrapped'):
+            if not _pkg_command(aem_url, aem_user, aem_passwd, 'build',
+                                package['name'], package['group'], report,
+                                install_options, package.get('lastWrapped', ''),
+                                'lastWrapped', version=package.get('version')):
+                module.fail_json(msg="Building package " + pkg_name + " is failed",
+                                 export=report)
             state_changed = True
-            message = "Installation package " + pkg_name + " was successful"
-        else:
+            rebuild = True
+            # size of the package is known after the build only
+            package = PackageInventory(aem_url, aem_user, aem_passwd).load().find(
+                package['name'], package['group'], package['version'])[0]
+        if not _pkg_download(aem_url, aem_user, aem_passwd, package,
+                             export_path, upload_chunk_size, report,
+                             resume=not rebuild):
+            module.fail_json(msg="Downloading package " + pkg_name + " is failed",
+                             export=report)
+        pkg_sha256, problem = _pkg_verify(export_path,
+                                          module.params.get('export_sha256'),
+                                          upload_chunk_size)
+        if problem:
+            module.fail_json(msg=problem, export=report, sha256=pkg_sha256)
+        report.update({'path': export_path, 'size': os.path.getsize(export_path),
+                       'sha256': pkg_sha256, 'package': _pkg_key(package)})
+        module.exit_json(changed=state_changed, export=report, sha256=pkg_sha256,
+                         msg="Package " + pkg_name + " exported to " + export_path)
 
-            message = "Installation package " + pkg_name + " is failed"
-            module.fail_json(msg=message)
+    if state in ['uploaded', 'installed']:
+        pkg_checksum = True
+        if not items:
+            module.fail_json(msg="pkg_path or packages is required with state " + state)
+    operation = 'Staging' if state == 'uploaded' else 'Installation'
 
-    if state in ['absent'] and _pgk_exist(aem_url, aem_user, aem_passwd,
-                                          pkg_name):
+    if state in ['present', 'uploaded', 'installed'] and aem_urls:
+        # the packages are read and hashed once for all nodes
+        if pkg_checksum:
+            for pkg in items:
+                pkg['sha256'] = _file_sha256(pkg['path'], upload_chunk_size)
+        start = time.time()
+        nodes = _pkg_rollout(aem_urls, aem_user, aem_passwd, items, pkg_index,
+                             aem_force, pkg_checksum, upload_chunk_size,
+                             module.params.get('parallel'),
+                             module.params.get('fail_policy') == 'fail_fast',
+                             state, install_options)
+        state_changed = any(result['status'] in ('installed', 'uploaded')
+                            for node in nodes.values()
+                            for result in node.get('packages', []))
+        failed = sorted(url for url, node in nodes.items()
+                        if node['status'] == 'failed')
+        if failed:
+            module.fail_json(msg=operation + " failed on " + ', '.join(failed),
+                             changed=state_changed, nodes=nodes,
+                             total_secs=time.time() - start)
+        module.exit_json(changed=state_changed, nodes=nodes,
+                         msg=operation + " on %d nodes was successful" % len(nodes),
+                         total_secs=time.time() - start)
+    elif aem_urls:
+        module.fail_json(msg="aem_urls is not supported with state " + state)
 
-        if _pkg_remove(aem_url, aem_user, aem_passwd, pkg_name):
+    if state in ['uploaded', 'installed'] or (state in ['present'] and packages):
+        start = time.time()
+        results, failure = _pkg_batch(inventory, aem_user, aem_passwd,
+                                      items, pkg_index, aem_force,
+                                      pkg_checksum, upload_chunk_size, state,
+                                      install_options)
+        done = [result for result in results
+                if result['status'] in ('installed', 'uploaded')]
+        state_changed = bool(done)
+        if failure is not None:
+            module.fail_json(msg=failure, changed=state_changed,
+                             packages=results,
+                             total_secs=time.time() - start)
+        message = operation + " of %d packages was successful" % len(done)
+        module.exit_json(changed=state_changed, msg=message, packages=results,
+                         total_secs=time.time() - start)
 
-            state_changed = True
-            message = "Removing package " + pkg_name + " was successful"
-        else:
-            message = "Removing package " + pkg_name + " is failed"
-            module.fail_json(msg=message)
+    if state in ['present']:
+        action, target, pkg_sha256 = _pkg_plan(
+            inventory, pkg_index, pkg_name, pkg_path, pkg_group, pkg_version,
+            aem_force, pkg_checksum, upload_chunk_size)
+
+        if action == 'install':
+            if _pkg_inst(aem_url, aem_user, aem_passwd, target['name'],
+                         target.get('group'), install_report, install_options,
+                         target.get('lastUnpacked', ''), target.get('version')):
+                state_changed = True
+                message = "Installation of uploaded package " + pkg_name + " was successful"
+                _pkg_installed(inventory, pkg_index, target)
+            else:
+                message = "Installation of uploaded package " + pkg_name + " is failed"
+                module.fail_json(msg=message, sha256=pkg_sha256,
+                                 install=install_report)
+
+        if action == 'upload':
+            if pkg_validate_remote and not _pkg_validate(aem_url, aem_user, aem_passwd,
+                                                         pkg_name, pkg_path,
+                                                         stats=upload_stats,
+                                                         chunk_size=upload_chunk_size):
+                message = "validation of  package " + pkg_name + " is failed"
+                module.fail_json(msg=message, upload=upload_stats)
+
+            uploaded = {}
+            if _pkg_install(aem_url, aem_user, aem_passwd, pkg_name, pkg_path,
+                            force=True, stats=upload_stats,
+                            chunk_size=upload_chunk_size, uploaded=uploaded,
+                            report=install_report, options=install_options):
+
+                state_changed = True
+                message = "Installation package " + pkg_name + " was successful"
+                if pkg_checksum and pkg_sha256 is None:
+                    pkg_sha256 = _file_sha256(pkg_path, upload_chunk_size)
+                _pkg_installed(inventory, pkg_index, uploaded,
+                               pkg_sha256 if pkg_checksum else None)
+            else:
+
+                message = "Installation package " + pkg_name + " is failed"
+                module.fail_json(msg=message, upload=upload_stats,
+                                 install=install_report)
+
+    if state in ['absent']:
+        remote_pkgs = _pkg_find(inventory, pkg_name, pkg_group, pkg_version)
+
+    if state in ['absent'] and remote_pkgs:
+
+        indexed = _index_load(pkg_index).get(aem_url, {})
+        for pkg in remote_pkgs:
+            if not _pkg_remove(aem_url, aem_user, aem_passwd, pkg['name'],
+                               pkg['group']):
+                message = "Removing package " + pkg_name + " is failed"
+                module.fail_json(msg=message)
+            inventory.remove(pkg)
+            if _pkg_key(pkg) in indexed:
+                _index_update(pkg_index, aem_url, _pkg_key(pkg), None)
+
+        state_changed = True
+        message = "Removing package " + pkg_name + " was successful"
 
-    module.exit_json(changed=state_changed, msg=message)
+    module.exit_json(changed=state_changed, msg=message, upload=upload_stats,
+                     sha256=pkg_sha256, install=install_report)
 
 
 main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2019, Lean Delivery Team <team@lean-delivery.com>
+# GNU General Public License v3.0+ (see COPYING or
+# https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# Compare the factory lookup of aem_osgi on a synthetic Configurations.txt
+# dump: the former regex search per instance against the single pass
+# parser, and the former key by key matching of every instance against
+# the hash index. Usage:
+# python benchmarks/osgi_configurations.py [configs] [factories]
+
+import os
+import re
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aem_osgi import OsgiSnapshot, canonical_key, normalize_value, parse_configurations  # noqa: E402
+
+FACTORY = 'org.apache.sling.commons.log.LogManager.factory.config'
+
+
+def synthetic_dump(configs=5000, factories=10):
+    # every second configuration is an instance of one of the factories
+    lines = ['*** Date: Mon, 1 Jan 2024 00:00:00 UTC',
+             '*** Configuration PID count: %d' % configs, '']
+    for i in range(configs):
+        if i % 2:
+            factory_pid = FACTORY if i % (2 * factories) == 1 else '%s%d' % (FACTORY, i % factories)
+            lines.append('PID = %s.%s' % (factory_pid, uuid.uuid4()))
+            lines.append('Factory PID = %s' % factory_pid)
+        else:
+            lines.append('PID = com.example.service.Component%d' % i)
+        lines.append('BundleLocation = launchpad:resources/install/0/bundle%d.jar' % (i % 300))
+        lines.append('  org.apache.sling.commons.log.file = logs/log%d.log' % i)
+        lines.append('  org.apache.sling.commons.log.level = info')
+        lines.append('  org.apache.sling.commons.log.names = [com.example.a%d, com.example.b%d]' % (i, i))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def legacy_find_factory(text, factory_id):
+    # the lookup aem_osgi did before the single pass parser
+    instances = re.findall(
+        '^PID.*=.*(%s\.[a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12})\s*$' % factory_id,
+        text, flags=re.M)
+    factories = {}
+    for fi in instances:
+        factory_data = re.findall('(PID = %s.*?)\n^PID' % fi, text,
+                                  flags=re.DOTALL | re.M)
+        factory = {}
+        for kvp in factory_data[0].splitlines() if factory_data else []:
+            (k, v) = kvp.strip().split('=', 1)
+            factory[k.strip()] = v.strip()
+        factories[fi] = factory
+    return factories
+
+
+def legacy_find_factory_match(instances, value):
+    # the matching aem_osgi did before the hash index
+    matches = []
+    for f, d in instances.items():
+        v_match = 0
+        for k, v in value.items():
+            if isinstance(v, int):
+                v = str(v)
+            if isinstance(v, list):
+                v = str(v).replace("'", "")
+            if v == d[k]:
+                v_match += 1
+        if v_match == len(value.keys()):
+            matches.append(f)
+    return matches
+
+
+def main():
+    configs = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    factories = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    text = synthetic_dump(configs, factories)
+    print('dump: %d configurations, %d bytes' % (configs, len(text)))
+
+    start = time.time()
+    index = parse_configurations(text.splitlines())[1].get(FACTORY, {})
+    parsed = time.time() - start
+    print('single pass: %d instances in %.3fs' % (len(index), parsed))
+
+    start = time.time()
+    legacy = legacy_find_factory(text, FACTORY)
+    searched = time.time() - start
+    print('regex:       %d instances in %.3fs' % (len(legacy), searched))
+    print('speedup:     %.1fx' % (searched / parsed if parsed else float('inf')))
+
+    # every instance is looked up once, as a baseline of that size does
+    wanted = [dict((k, props[k]) for k in ('org.apache.sling.commons.log.file',
+                                           'org.apache.sling.commons.log.level'))
+              for props in legacy.values()]
+    start = time.time()
+    found = sum(len(legacy_find_factory_match(legacy, value)) for value in wanted)
+    linear = time.time() - start
+    print('match key by key: %d found in %.3fs' % (found, linear))
+
+    snapshot = OsgiSnapshot(None, None, None)
+    snapshot.loaded = True
+    snapshot.factories[FACTORY] = dict(
+        (pid, dict((k, normalize_value(v, text=True)) for k, v in props.items()))
+        for pid, props in index.items())
+    start = time.time()
+    keys = sorted(wanted[0])
+    found = sum(len(snapshot.factory_index(FACTORY, keys).get(
+        canonical_key(value, keys), [])) for value in wanted)
+    indexed = time.time() - start
+    print('match by index:   %d found in %.3fs' % (found, indexed))
+
+
+if __name__ == '__main__':
+    main()